@@ -9,16 +9,15 @@ calculating their hashes, storing them in SQLite, and generating HTML reports.
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 # Custom Module Imports
 from utilities.arguments import parse_arguments
-from utilities.hash_calculator import calculate_directory_hashes_optimized, calculate_file_hash_tiered, get_file_size, get_file_modified_time
-from utilities.database import initialize_database, upsert_files, get_last_scan_timestamp, update_last_scan_timestamp, _chunk_data
+from utilities.hash_calculator import HASH_THREADS, calculate_directory_hashes_optimized, hash_files_tiered, get_file_size, get_file_modified_time, walk_files
+from utilities.database import initialize_database, DBWriter, upsert_files, upsert_file_entries_batch, get_files_needing_tier1, get_full_hash_candidates, get_last_scan_timestamp, update_last_scan_timestamp, get_files_by_paths
 from utilities.html_generator import generate_html_report
 
-from sqlalchemy import Column, Integer, String, BigInteger, Float, Table, MetaData, select, insert
-
 
 BATCH_SIZE = 1000  # Number of files to process before database commit
 
@@ -41,9 +40,6 @@ def main():
         # Initialize database
         print("Initializing database")
         initialize_database(args.db_url)
-        
-        # Import engine after initialization to get the updated value
-        from utilities.database import engine
     
         # Optimized scanning with two-tier hashing
         print(f"\n--- Optimized Two-Tier Hashing Scan ---")
@@ -60,61 +56,24 @@ def main():
             modified_time = get_file_modified_time(abs_path)
             files_to_process.append((filename, abs_path, file_size, scan_date, modified_time))
         else:
-            # Discovery phase
-            for root, _, files in os.walk(path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    abs_file_path = os.path.abspath(file_path)
-                    try:
-                        if args.verbose:
-                            print(f"Discovering {abs_file_path}")
-                        file_size = os.path.getsize(abs_file_path)
-                        modified_time = get_file_modified_time(abs_file_path)
-                        files_to_process.append((file, abs_file_path, file_size, scan_date, modified_time))
-                    except OSError as e:
-                        if args.verbose:
-                            print(f"Error accessing {abs_file_path}: {e}")
-                        import traceback
-                        traceback.print_exc()
+            # Discovery phase (one stat per file via scandir)
+            for file, abs_file_path, file_size, modified_time in walk_files(path):
+                if args.verbose:
+                    print(f"Discovering {abs_file_path}")
+                files_to_process.append((file, abs_file_path, file_size, scan_date, modified_time))
         
         print(f"Found {len(files_to_process)} files. Syncing with database...")
         
-        # Import necessary SQLAlchemy components
-        from sqlalchemy import MetaData, Table, select
-        metadata = MetaData()
-        table = Table('file_hashes', metadata,
-                      Column('id', Integer, primary_key=True),
-                      Column('filename', String, nullable=False),
-                      Column('absolute_path', String, nullable=False, unique=True),
-                      Column('tier1_hash', String, nullable=False),
-                      Column('hash_value', String, nullable=True),
-                      Column('file_size', BigInteger, nullable=False),
-                      Column('scan_date', Float, nullable=False),
-                      Column('modified_time', Float, nullable=True),
-                      extend_existing=True)
-        
         # Batch query existing files
         paths = [item[1] for item in files_to_process]
-        existing_files = {}
         last_scan_ts = get_last_scan_timestamp()
         
-        with engine.connect() as connection:
-            for chunk_paths in _chunk_data(paths, 900):
-                query = select(table.c.absolute_path, table.c.file_size, table.c.hash_value,
-                              table.c.tier1_hash, table.c.modified_time, table.c.scan_date).where(
-                    table.c.absolute_path.in_(chunk_paths))
-                result = connection.execute(query)
-                for row in result:
-                    existing_files[row.absolute_path] = {
-                        'file_size': row.file_size,
-                        'hash_value': row.hash_value,
-                        'tier1_hash': row.tier1_hash,
-                        'modified_time': row.modified_time,
-                        'scan_date': row.scan_date
-                    }
+        existing_files = get_files_by_paths(paths)
         
-        # Separate unchanged and pending
-        unchanged_count = 0
+        # Separate settled and pending files. A file is settled when its size and mtime
+        # match the stored row: whatever hashes that row holds (full, tier1 only, or none
+        # for a unique size) are still valid and are not recomputed
+        unchanged_updates = []
         pending_list = []
         
         with tqdm(total=len(files_to_process), desc="Processing metadata") as pbar:
@@ -122,41 +81,65 @@ def main():
                 filename, abs_path, size, scan_date, modified_time = item
                 stored = existing_files.get(abs_path)
                 is_unchanged = (stored and
-                                stored['hash_value'] and stored['hash_value'] != '' and
-                                stored['tier1_hash'] and stored['tier1_hash'] != '' and
                                 stored['file_size'] == size and
                                 last_scan_ts is not None and
                                 (abs(modified_time - stored['modified_time']) < 1e-6 or modified_time < last_scan_ts))
                 if is_unchanged:
-                    # Update scan_date for unchanged files
-                    with engine.begin() as connection:
-                        stmt = table.update().where(table.c.absolute_path == abs_path).values(
-                            filename=filename, scan_date=scan_date, modified_time=modified_time)
-                        connection.execute(stmt)
-                    unchanged_count += 1
+                    # Refresh scan_date for unchanged files, keeping their stored hashes
+                    unchanged_updates.append({
+                        'filename': filename,
+                        'absolute_path': abs_path,
+                        'tier1_hash': stored['tier1_hash'],
+                        'hash_value': stored['hash_value'],
+                        'file_size': size,
+                        'scan_date': scan_date,
+                        'modified_time': modified_time
+                    })
                 else:
                     pending_list.append((filename, abs_path, size, scan_date, modified_time))
                 pbar.update(1)
         
-        print(f"Processed metadata. Skipped {unchanged_count} unchanged files.")
+        upsert_file_entries_batch(unchanged_updates, batch_size=BATCH_SIZE)
+        print(f"Processed metadata. Skipped {len(unchanged_updates)} unchanged files.")
         
-        file_hashes = []
         if pending_list:
-            pending_paths = [item[1] for item in pending_list]
-            print(f"Computing hashes for {len(pending_list)} pending files...")
-            with tqdm(total=len(pending_list), desc="Hashing files") as pbar:
-                for filename, abs_path, size, scan_date, modified_time in pending_list:
-                    if args.verbose:
-                        print(f"Hashing {abs_path}")
-                    tier1_hash, full_hash = calculate_file_hash_tiered(abs_path, args.algorithm)
-                    file_hashes.append((filename, abs_path, tier1_hash, full_hash, size, scan_date, modified_time))
-                    pbar.update(1)
-        
-        print(f"Found and processed {len(file_hashes)} pending files with two-tier hashing.")
+            # Record pending files (hashes cleared) so sizes can be compared across the whole database
+            upsert_files(None, [(filename, abs_path, '', '', size, scan_date, modified_time)
+                                for filename, abs_path, size, scan_date, modified_time in pending_list])
+            # One hashing pool serves both the tier1 and the full pass
+            with ThreadPoolExecutor(max_workers=HASH_THREADS) as hash_pool:
+                # A file whose size no other file has cannot be a duplicate: leave it unhashed.
+                # Settled files come back only when a pending file now shares their size.
+                # Only files found by this scan are opened; other roots and deleted files stay untouched
+                to_hash = get_files_needing_tier1(paths)
+                print(f"Computing tier1 hashes for {len(to_hash)} files...")
+                tier1_rows = []
+                with tqdm(total=len(to_hash), desc="Computing tier1 hashes") as pbar:
+                    for (filename, abs_path, size, scan_date, modified_time), (tier1_hash, _) in zip(
+                            to_hash, hash_files_tiered([item[1] for item in to_hash], args.algorithm, compute_full=False,
+                                                        executor=hash_pool)):
+                        # Unreadable files keep an empty tier1 hash rather than the error text
+                        if not tier1_hash.startswith("ERROR:"):
+                            tier1_rows.append((filename, abs_path, tier1_hash, None, size, scan_date, modified_time))
+                        pbar.update(1)
+                upsert_files(None, tier1_rows)
+
+                # Full hash only where size and tier1 collide, in this scan or with a stored file.
+                # Selected before the writer starts so no database reads overlap its flushes
+                candidates = get_full_hash_candidates(paths)
+                print(f"Computing full hashes for {len(candidates)} candidates...")
+                # Files are hashed on a thread pool; a background writer upserts results meanwhile
+                with DBWriter(flush_every=BATCH_SIZE) as writer:
+                    hashes = hash_files_tiered([item[1] for item in candidates], args.algorithm, executor=hash_pool)
+                    with tqdm(total=len(candidates), desc="Computing full hashes") as pbar:
+                        for (filename, abs_path, tier1_hash, size, scan_date, modified_time), (_, full_hash) in zip(candidates, hashes):
+                            if args.verbose:
+                                print(f"Hashed {abs_path}")
+                            if not full_hash.startswith("ERROR:"):
+                                writer.put((filename, abs_path, tier1_hash, full_hash, size, scan_date, modified_time))
+                            pbar.update(1)
         
-        # Upsert pending data
-        if file_hashes:
-            upsert_files(None, file_hashes)
+        print(f"Found and processed {len(pending_list)} pending files with two-tier hashing.")
         
         print(f"Optimized scan completed in {time.time() - optimized_start:.2f} seconds")
         
@@ -166,7 +149,7 @@ def main():
         # Generate HTML report (unless skipped)
         if not args.skip_html:
             print("\nGenerating HTML report...")
-            generate_html_report(args.report)
+            generate_html_report(args.report, duplicates_only=args.duplicates_only)
             print(f"HTML Report: {args.report}")
         else:
             print("\nHTML report generation skipped (--skip-html flag set).")
@@ -0,0 +1,28 @@
+import gc
+import sqlite3
+import pytest
+from utilities import database
+from utilities.database import initialize_database, Base
+
+
+@pytest.fixture(scope="session")
+def db_engine(tmp_path_factory):
+    """Initialize one SQLite database for the whole test session."""
+    db_path = str(tmp_path_factory.mktemp("db") / "test_file_hashes.db")
+    initialize_database(f"sqlite:///{db_path}")
+    yield db_path
+    # Release pooled connections and flush WAL/SHM sidecars so tmp cleanup is not blocked
+    if database.engine:
+        database.engine.dispose()
+    database.engine = None
+    sqlite3.connect(db_path).execute("PRAGMA wal_checkpoint(TRUNCATE)").close()
+    gc.collect()
+
+
+@pytest.fixture(scope="function")
+def temp_db(db_engine):
+    """Provide an empty database per test without re-running schema creation."""
+    yield db_engine
+    with database.engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
@@ -1,44 +1,38 @@
 import os
+import threading
 import time
 from datetime import datetime
 import pytest
 import tempfile
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
+from utilities import database
 from utilities.database import (
     initialize_database,
     get_file_by_path,
+    get_files_by_paths,
+    has_tier1_match,
+    get_shared_sizes,
+    get_files_needing_tier1,
+    get_full_hash_candidates,
+    get_duplicates,
+    iter_all_records,
+    iter_duplicate_records,
+    get_pending_files,
+    HashUpdateBatcher,
+    DBWriter,
     is_file_unchanged,
+    is_file_unchanged_bulk,
     update_last_scan_timestamp,
     get_last_scan_timestamp,
     upsert_file_entry,
     upsert_files,
+    upsert_file_entries_batch,
+    save_to_database,
     engine
 )
 
 
-@pytest.fixture(scope="function")
-def temp_db():
-    """Create a temporary in-memory database for testing."""
-    db_fd, db_path = tempfile.mkstemp(suffix=".db")
-    os.close(db_fd)
-    try:
-        # Initialize the database
-        initialize_database(db_path)
-        yield db_path
-    finally:
-        global engine
-        if engine:
-            engine.dispose()
-        engine = None
-        time.sleep(0.5)
-        if os.path.exists(db_path):
-            try:
-                os.unlink(db_path)
-            except PermissionError:
-                pass
-
-
 def test_get_file_by_path_not_found(temp_db):
     """Test get_file_by_path when file does not exist."""
     result = get_file_by_path("/nonexistent/path")
@@ -52,10 +46,11 @@ def test_get_file_by_path_success(temp_db):
     upsert_file_entry(
         "/test/path/file.txt",
         "file.txt",
-        1024,
-        1234567890.0,
-        "abc123hash",
-        current_epoch
+        '',
+        hash_value="abc123hash",
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=current_epoch
     )
     
     result = get_file_by_path("/test/path/file.txt")
@@ -68,6 +63,183 @@ def test_get_file_by_path_success(temp_db):
     assert abs(result["scan_date"] - current_epoch) < 1
 
 
+def test_get_files_by_paths(temp_db):
+    """Test bulk lookup returns stored rows keyed by path and omits unknown paths."""
+    upsert_file_entries_batch([
+        {'absolute_path': f"/test/bulk/{i}.txt", 'filename': f"{i}.txt", 'hash_value': f"hash{i}",
+         'file_size': i, 'modified_time': float(i)}
+        for i in range(3)
+    ])
+
+    found = get_files_by_paths(["/test/bulk/0.txt", "/test/bulk/2.txt", "/test/bulk/missing.txt"])
+    assert set(found) == {"/test/bulk/0.txt", "/test/bulk/2.txt"}
+    assert found["/test/bulk/2.txt"]["hash_value"] == "hash2"
+    assert found["/test/bulk/2.txt"]["file_size"] == 2
+    # Temp table is cleared between calls
+    assert set(get_files_by_paths(["/test/bulk/1.txt"])) == {"/test/bulk/1.txt"}
+    assert get_files_by_paths([]) == {}
+
+
+def test_has_tier1_match(temp_db):
+    """Test tier1 lookups match on size and tier1 hash together."""
+    upsert_file_entries_batch([
+        {'absolute_path': "/test/t1/a", 'filename': "a", 'tier1_hash': "t1", 'hash_value': "h", 'file_size': 10, 'modified_time': 1.0},
+    ])
+
+    assert has_tier1_match(10, "t1")
+    assert not has_tier1_match(11, "t1")
+    assert not has_tier1_match(10, "other")
+    assert not has_tier1_match(10, "t1", exclude_path="/test/t1/a")
+
+
+def test_get_shared_sizes(temp_db):
+    """Test only sizes stored more than once are returned."""
+    upsert_file_entries_batch([
+        {'absolute_path': f"/test/sizes/{name}", 'filename': name, 'file_size': size, 'modified_time': 1.0}
+        for name, size in [("a", 10), ("b", 10), ("c", 20), ("d", 30), ("e", 30), ("f", 30)]
+    ])
+
+    assert get_shared_sizes() == {10, 30}
+
+
+def test_get_files_needing_tier1(temp_db):
+    """Test only files of a shared size that lack a tier1 hash are returned."""
+    upsert_files(None, [
+        ("a", "/test/t1/a", "", "", 10, 1.0, 1.0),
+        ("b", "/test/t1/b", "", "", 10, 1.0, 1.0),
+        ("c", "/test/t1/c", "t", "", 10, 1.0, 1.0),
+        ("d", "/test/t1/d", "", "", 20, 1.0, 1.0),
+    ])
+
+    assert sorted(row[1] for row in get_files_needing_tier1()) == ["/test/t1/a", "/test/t1/b"]
+    # Restricted to the scanned paths; b still counts towards the shared size
+    assert [row[1] for row in get_files_needing_tier1(["/test/t1/a", "/test/t1/d"])] == ["/test/t1/a"]
+    assert get_files_needing_tier1([]) == []
+
+
+def test_get_full_hash_candidates(temp_db):
+    """Test files whose size and tier1 collide are returned unless already fully hashed."""
+    upsert_files(None, [
+        ("a", "/test/full/a", "t1", "", 10, 1.0, 1.0),
+        ("b", "/test/full/b", "t1", "h", 10, 1.0, 1.0),
+        ("c", "/test/full/c", "t2", "", 10, 1.0, 1.0),
+        ("d", "/test/full/d", "t1", "", 20, 1.0, 1.0),
+        ("e", "/test/full/e", "t3", "", 30, 1.0, 1.0),
+        ("f", "/test/full/f", "t3", "", 30, 1.0, 1.0),
+    ])
+
+    assert sorted(row[1] for row in get_full_hash_candidates()) == ["/test/full/a", "/test/full/e", "/test/full/f"]
+    # A scanned file may collide with a stored file outside the scanned paths
+    assert [row[1] for row in get_full_hash_candidates(["/test/full/e", "/test/full/d"])] == ["/test/full/e"]
+
+
+def test_get_duplicates(temp_db):
+    """Test duplicate hashes are grouped in SQL, honouring min_size and skipping unhashed files."""
+    upsert_file_entries_batch([
+        {'absolute_path': "/test/dup/a1", 'filename': "a1", 'hash_value': "aaa", 'file_size': 100, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/a2", 'filename': "a2", 'hash_value': "aaa", 'file_size': 100, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/b1", 'filename': "b1", 'hash_value': "bbb", 'file_size': 5, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/b2", 'filename': "b2", 'hash_value': "bbb", 'file_size': 5, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/c1", 'filename': "c1", 'hash_value': "ccc", 'file_size': 100, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/u1", 'filename': "u1", 'file_size': 100, 'modified_time': 1.0},
+        {'absolute_path': "/test/dup/u2", 'filename': "u2", 'file_size': 100, 'modified_time': 1.0},
+    ])
+
+    assert sorted(get_duplicates()) == [("aaa", 2), ("bbb", 2)]
+    assert get_duplicates(min_size=50) == [("aaa", 2)]
+
+
+def test_iter_all_records_order_by_hash(temp_db):
+    """Test records can be streamed with equal hashes adjacent."""
+    upsert_file_entries_batch([
+        {'absolute_path': f"/test/order/{i}", 'filename': str(i), 'hash_value': h, 'file_size': 10, 'modified_time': 1.0}
+        for i, h in enumerate(["bbb", "aaa", "bbb", "aaa"])
+    ])
+
+    hashes = [row[2] for row in iter_all_records(order_by_hash=True)]
+    assert hashes == ["aaa", "aaa", "bbb", "bbb"]
+
+
+def test_iter_duplicate_records(temp_db):
+    """Test only files sharing a full hash are streamed, grouped by hash."""
+    upsert_file_entries_batch([
+        {'absolute_path': f"/test/dups/{i}", 'filename': str(i), 'hash_value': h, 'file_size': 10, 'modified_time': 1.0}
+        for i, h in enumerate(["bbb", "aaa", "ccc", "bbb", "aaa"])
+    ] + [
+        {'absolute_path': f"/test/dups/u{i}", 'filename': f"u{i}", 'file_size': 10, 'modified_time': 1.0}
+        for i in range(2)
+    ])
+
+    hashes = [row[2] for row in iter_duplicate_records()]
+    assert hashes == ["aaa", "aaa", "bbb", "bbb"]
+
+
+def test_hash_update_batcher(temp_db):
+    """Test batcher flushes when full and on exit."""
+    upsert_file_entries_batch([
+        {'absolute_path': f"/test/batcher/{i}", 'filename': str(i), 'file_size': i, 'modified_time': 1.0}
+        for i in range(3)
+    ])
+    pending = list(get_pending_files())
+
+    with HashUpdateBatcher(flush_every=2) as batcher:
+        for file_id, path in pending:
+            batcher.add(file_id, "hash-" + path)
+        # Two updates flushed automatically, the third waits for exit
+        assert len(batcher.buffer) == 1
+        assert len(list(get_pending_files())) == 1
+
+    assert list(get_pending_files()) == []
+    assert get_file_by_path("/test/batcher/2")["hash_value"] == "hash-/test/batcher/2"
+
+
+def test_db_writer(temp_db):
+    """Test background writer upserts every queued row, across flushes and on close."""
+    with DBWriter(flush_every=2, maxsize=1) as writer:
+        for i in range(5):
+            writer.put((f"{i}.txt", f"/test/writer/{i}.txt", f"t{i}", f"h{i}", i, 1.0, 1.0))
+
+    assert not writer.is_alive()
+    for i in range(5):
+        assert get_file_by_path(f"/test/writer/{i}.txt")["hash_value"] == f"h{i}"
+
+
+def test_db_writer_flush_interval(temp_db):
+    """Test a partial batch is written once flush_interval elapses, before close."""
+    with DBWriter(flush_every=100, flush_interval=0.05) as writer:
+        writer.put(("slow.txt", "/test/writer/slow.txt", "t", "h", 1, 1.0, 1.0))
+        deadline = time.monotonic() + 5
+        while get_file_by_path("/test/writer/slow.txt") is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert get_file_by_path("/test/writer/slow.txt") is not None
+        assert writer.is_alive()
+
+
+def test_db_writer_concurrent_reads(temp_db):
+    """Test reads on another thread cannot roll back the writer's open transaction."""
+    rows = 50000
+    stop = threading.Event()
+
+    def read_until_stopped():
+        while not stop.is_set():
+            has_tier1_match(1, "t", "/test/concurrent/0")
+
+    reader = threading.Thread(target=read_until_stopped)
+    reader.start()
+    try:
+        with DBWriter(flush_every=5000) as writer:
+            for i in range(rows):
+                writer.put((f"{i}", f"/test/concurrent/{i}", "t", "h", 1, 1.0, 1.0))
+    finally:
+        stop.set()
+        reader.join()
+
+    with database.engine.connect() as connection:
+        stored = connection.exec_driver_sql(
+            "SELECT COUNT(*) FROM file_hashes WHERE absolute_path LIKE '/test/concurrent/%'").scalar()
+    assert stored == rows
+
+
 def test_is_file_unchanged_true(temp_db):
     """Test is_file_unchanged returns True for unchanged file."""
     # Insert a test entry
@@ -75,10 +247,11 @@ def test_is_file_unchanged_true(temp_db):
     upsert_file_entry(
         "/test/path/file.txt",
         "file.txt",
-        1024,
-        1234567890.0,
-        "abc123hash",
-        current_epoch
+        '',
+        hash_value="abc123hash",
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=current_epoch
     )
     
     # Set last scan timestamp before the file's mtime
@@ -96,10 +269,11 @@ def test_is_file_unchanged_false_newer_modified_time(temp_db):
     upsert_file_entry(
         "/test/path/file.txt",
         "file.txt",
-        1024,
-        1234567890.0,
-        "abc123hash",
-        current_epoch
+        '',
+        hash_value="abc123hash",
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=current_epoch
     )
     
     update_last_scan_timestamp(1234567880.0)
@@ -121,10 +295,11 @@ def test_is_file_unchanged_false_no_last_scan(temp_db):
     upsert_file_entry(
         "/test/path/file.txt",
         "file.txt",
-        1024,
-        1234567890.0,
-        "abc123hash",
-        current_epoch
+        '',
+        hash_value="abc123hash",
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=current_epoch
     )
     
     # No last scan timestamp set
@@ -132,6 +307,27 @@ def test_is_file_unchanged_false_no_last_scan(temp_db):
     assert result is False
 
 
+def test_is_file_unchanged_bulk(temp_db):
+    """Test is_file_unchanged_bulk classifies many files in one pass."""
+    for name in ("a.txt", "b.txt"):
+        upsert_file_entry(
+            f"/test/path/{name}",
+            name,
+            '',
+            hash_value="abc123hash",
+            file_size=1024,
+            modified_time=1234567890.0
+        )
+    update_last_scan_timestamp(1234567880.0)
+
+    result = is_file_unchanged_bulk([
+        ("/test/path/a.txt", 1234567890.0),  # Unchanged
+        ("/test/path/b.txt", 1234567900.0),  # Newer modified_time
+        ("/nonexistent/path", 1234567890.0),  # No entry
+    ])
+    assert result == {"/test/path/a.txt"}
+
+
 def test_update_last_scan_timestamp(temp_db):
     """Test updating last scan timestamp."""
     timestamp = 1234567890.0
@@ -153,9 +349,10 @@ def test_upsert_file_entry_insert(temp_db):
     upsert_file_entry(
         path,
         "new.txt",
-        2048,
-        1234567891.0,
-        "def456hash"
+        '',
+        hash_value="def456hash",
+        file_size=2048,
+        modified_time=1234567891.0
     )
     
     result = get_file_by_path(path)
@@ -172,10 +369,11 @@ def test_upsert_file_entry_update(temp_db):
     upsert_file_entry(
         path,
         "update.txt",
-        1024,
-        1234567890.0,
-        "oldhash",
-        current_epoch1
+        '',
+        hash_value="oldhash",
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=current_epoch1
     )
     
     current_epoch2 = time.time()
@@ -183,8 +381,9 @@ def test_upsert_file_entry_update(temp_db):
     upsert_file_entry(
         path,
         "update.txt",
-        2048,
-        1234567892.0,
+        '',
+        file_size=2048,
+        modified_time=1234567892.0,
         scan_date=current_epoch2
     )
     
@@ -196,6 +395,59 @@ def test_upsert_file_entry_update(temp_db):
     assert abs(result["scan_date"] - current_epoch2) < 1
 
 
+def test_upsert_file_entry_unchanged_refreshes_scan_date(temp_db):
+    """Test re-upserting unchanged metadata keeps the hash and refreshes scan_date."""
+    path = "/test/path/unchanged.txt"
+    upsert_file_entry(path, "unchanged.txt", '', hash_value="samehash", file_size=10,
+                      modified_time=1234567890.0, scan_date=1000.0)
+
+    row = upsert_file_entry(path, "unchanged.txt", '', file_size=10,
+                            modified_time=1234567890.0, scan_date=2000.0)
+
+    assert row is not None and row[1:] == (path, "samehash")
+    result = get_file_by_path(path)
+    assert result["hash_value"] == "samehash"
+    assert result["scan_date"] == 2000.0
+
+
+def test_upsert_file_entries_batch(temp_db):
+    """Test batch upsert keeps hashes of unchanged files and resets changed ones."""
+    upsert_file_entries_batch([
+        {'absolute_path': "/test/batch/a.txt", 'filename': "a.txt", 'hash_value': "hash_a",
+         'file_size': 10, 'modified_time': 100.0},
+        {'absolute_path': "/test/batch/b.txt", 'filename': "b.txt", 'hash_value': "hash_b",
+         'file_size': 20, 'modified_time': 200.0},
+    ])
+
+    # Rescan without hashes: a.txt unchanged, b.txt modified, c.txt new
+    upsert_file_entries_batch([
+        {'absolute_path': "/test/batch/a.txt", 'filename': "a.txt", 'file_size': 10, 'modified_time': 100.0},
+        {'absolute_path': "/test/batch/b.txt", 'filename': "b.txt", 'file_size': 25, 'modified_time': 250.0},
+        {'absolute_path': "/test/batch/c.txt", 'filename': "c.txt", 'file_size': 30, 'modified_time': 300.0},
+    ], batch_size=2)
+
+    assert get_file_by_path("/test/batch/a.txt")["hash_value"] == "hash_a"
+    b = get_file_by_path("/test/batch/b.txt")
+    assert b["hash_value"] == ""
+    assert b["file_size"] == 25
+    assert get_file_by_path("/test/batch/c.txt")["hash_value"] == ""
+
+
+def test_save_to_database_tuples(temp_db):
+    """Test save_to_database writes positional tuples and upserts on path."""
+    save_to_database(None, iter([
+        ("a.txt", "/test/save/a.txt", "aaa", 10, 1000.0),
+        ("b.txt", "/test/save/b.txt", "bbb", 20, 1000.0),
+    ]))
+    save_to_database(None, [("a2.txt", "/test/save/a.txt", "ccc", 30, 2000.0)])
+
+    row = get_file_by_path("/test/save/a.txt")
+    assert (row["filename"], row["hash_value"], row["file_size"], row["scan_date"]) == ("a2.txt", "ccc", 30, 2000.0)
+    with database.engine.connect() as connection:
+        assert connection.execute(text("SELECT tier1_hash FROM file_hashes WHERE absolute_path = '/test/save/a.txt'")).scalar() == ""
+    assert get_file_by_path("/test/save/b.txt")["hash_value"] == "bbb"
+
+
 def test_upsert_file_entry_epoch_storage(temp_db):
     """Test that upsert_file_entry stores scan_date as epoch float."""
     path = "/test/path/epoch.txt"
@@ -203,10 +455,11 @@ def test_upsert_file_entry_epoch_storage(temp_db):
     upsert_file_entry(
         path,
         "epoch.txt",
-        1024,
-        1234567890.0,
-        None,
-        epoch_time
+        '',
+        hash_value=None,
+        file_size=1024,
+        modified_time=1234567890.0,
+        scan_date=epoch_time
     )
     
     result = get_file_by_path(path)
@@ -216,7 +469,6 @@ def test_upsert_file_entry_epoch_storage(temp_db):
 
 def test_upsert_normalization_relative_paths(temp_db):
     """Test that upsert functions normalize relative paths to absolute in storage."""
-    current_dir = os.getcwd()
     rel_path = "test_rel.txt"
     abs_path = os.path.abspath(rel_path)
     current_epoch = time.time()
@@ -225,10 +477,11 @@ def test_upsert_normalization_relative_paths(temp_db):
     upsert_file_entry(
         rel_path,
         "test_rel.txt",
-        1024,
-        current_epoch,
-        None,
-        current_epoch
+        '',
+        hash_value=None,
+        file_size=1024,
+        modified_time=current_epoch,
+        scan_date=current_epoch
     )
     result_entry = get_file_by_path(abs_path)
     assert result_entry is not None
@@ -236,12 +489,26 @@ def test_upsert_normalization_relative_paths(temp_db):
     assert os.path.isabs(result_entry["absolute_path"])
     
     # Test upsert_files with relative path
-    file_data = [("test_batch.txt", rel_path, 2048, current_epoch)]
+    file_data = [("test_batch.txt", rel_path, '', '', 2048, current_epoch, current_epoch)]
     upsert_files(None, file_data)
     result_batch = get_file_by_path(abs_path)
     assert result_batch is not None
     assert result_batch["absolute_path"] == abs_path  # Normalized
-    assert os.path.isabs(result_batch["absolute_path"])
-    
-    # Clean up
-    # Note: In real test, we'd delete, but since temp_db, it's fine
+    assert result_batch["file_size"] == 2048  # Same row updated, not a second one
+
+
+def test_initialize_database_idempotent(temp_db):
+    """Test re-initialising with the same URL keeps the existing engine."""
+    current_engine = database.engine
+    initialize_database(f"sqlite:///{temp_db}")
+    assert database.engine is current_engine
+
+
+def test_sqlite_optimize_on_checkin(temp_db, monkeypatch):
+    """Test PRAGMA optimize runs on checkin once the interval has elapsed."""
+    monkeypatch.setattr(database, "SQLITE_OPTIMIZE_INTERVAL", 0)
+    with database.engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        record = connection.connection._connection_record
+        before = record.info['optimized_at']
+    assert record.info['optimized_at'] > before
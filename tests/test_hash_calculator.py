@@ -1,45 +1,32 @@
+import hashlib
 import os
+import threading
+import time
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, mock_open
-from utilities.hash_calculator import get_file_modified_time, get_file_size, calculate_file_hash, calculate_file_hash_tiered, group_files_by_size, calculate_directory_hashes_optimized
+from utilities.hash_calculator import get_file_modified_time, get_file_size, calculate_file_hash, calculate_file_hash_tiered, group_files_by_size, calculate_directory_hashes_optimized, walk_files, MMAP_THRESHOLD, adaptive_chunk_size, MIN_CHUNK_SIZE, hash_files_tiered, bounded_map
 
 
-def test_get_file_modified_time_success():
-    """Test successful modified_time retrieval."""
-    test_path = "/test/path/file.txt"
-    mock_modified_time = 1234567890.0
-    
-    with patch('os.path.getmtime', return_value=mock_modified_time):
-        result = get_file_modified_time(test_path)
-        assert result == mock_modified_time
+# (helper, patched os.path function, mocked value, value returned on error)
+STAT_HELPER_CASES = [
+    pytest.param(get_file_modified_time, 'os.path.getmtime', 1234567890.0, 0.0, id="modified_time"),
+    pytest.param(get_file_size, 'os.path.getsize', 1024, -1, id="size"),
+]
 
 
-def test_get_file_modified_time_error():
-    """Test modified_time retrieval with error."""
-    test_path = "/test/path/file.txt"
-    
-    with patch('os.path.getmtime', side_effect=OSError("Permission denied")):
-        result = get_file_modified_time(test_path)
-        assert result == 0.0
-
-
-def test_get_file_size_success():
-    """Test successful file size retrieval."""
-    test_path = "/test/path/file.txt"
-    mock_size = 1024
-    
-    with patch('os.path.getsize', return_value=mock_size):
-        result = get_file_size(test_path)
-        assert result == mock_size
+@pytest.mark.parametrize("helper, target, mock_value, error_value", STAT_HELPER_CASES)
+def test_stat_helper_success(helper, target, mock_value, error_value):
+    """Test successful modified_time/size retrieval."""
+    with patch(target, return_value=mock_value):
+        assert helper("/test/path/file.txt") == mock_value
 
 
-def test_get_file_size_error():
-    """Test file size retrieval with error."""
-    test_path = "/test/path/file.txt"
-    
-    with patch('os.path.getsize', side_effect=OSError("Permission denied")):
-        result = get_file_size(test_path)
-        assert result == -1
+@pytest.mark.parametrize("helper, target, mock_value, error_value", STAT_HELPER_CASES)
+def test_stat_helper_error(helper, target, mock_value, error_value):
+    """Test modified_time/size retrieval with error."""
+    with patch(target, side_effect=OSError("Permission denied")):
+        assert helper("/test/path/file.txt") == error_value
 
 
 def test_calculate_file_hash_success():
@@ -62,12 +49,30 @@ def test_calculate_file_hash_error():
         assert result.startswith("ERROR:")
 
 
+def test_calculate_file_hash_large_file_mmap(tmp_path):
+    """Test files above the mmap threshold hash identically to a plain read."""
+    big = tmp_path / "big.bin"
+    data = os.urandom(MMAP_THRESHOLD + 12345)
+    big.write_bytes(data)
+
+    assert calculate_file_hash(str(big), "sha256") == hashlib.sha256(data).hexdigest()
+
+
+def test_calculate_file_hash_reused_buffer(tmp_path):
+    """Test files spanning many chunks hash identically through the readinto buffer."""
+    path = tmp_path / "medium.bin"
+    data = os.urandom(100 * 1024 + 3)
+    path.write_bytes(data)
+
+    assert calculate_file_hash(str(path), "sha256", chunk_size=4096) == hashlib.sha256(data).hexdigest()
+
+
 def test_calculate_file_hash_tiered_success():
     """Test successful tiered hash calculation."""
     test_path = "/test/path/file.txt"
-    mock_content = b"test content" * 10  # Enough for tier1 and full
-    expected_tier1 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of first 64KB (empty in this case, but adjust)
-    expected_full = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of all
+    mock_content = b"test content" * 10  # Smaller than tier1, so both hashes cover the whole content
+    expected_tier1 = hashlib.md5(mock_content).hexdigest()
+    expected_full = hashlib.md5(mock_content).hexdigest()
     
     with patch('builtins.open', mock_open(read_data=mock_content)):
         tier1, full = calculate_file_hash_tiered(test_path, "md5")
@@ -75,6 +80,103 @@ def test_calculate_file_hash_tiered_success():
         assert full == expected_full
 
 
+def test_calculate_file_hash_tiered_large_file(tmp_path):
+    """Test the full pass with adaptive reads matches a plain hash of the file."""
+    big = tmp_path / "big.bin"
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    big.write_bytes(data)
+
+    tier1, full = calculate_file_hash_tiered(str(big), "md5", chunk_size=256 * 1024)
+    assert tier1 == hashlib.md5(data[:65536]).hexdigest()
+    assert full == hashlib.md5(data).hexdigest()
+
+
+def test_calculate_file_hash_tiered_mmap(tmp_path):
+    """Test the mapped full pass past tier1 matches a plain hash of the file."""
+    big = tmp_path / "big.bin"
+    data = os.urandom(MMAP_THRESHOLD + 4321)
+    big.write_bytes(data)
+
+    tier1, full = calculate_file_hash_tiered(str(big), "sha256")
+    assert tier1 == hashlib.sha256(data[:65536]).hexdigest()
+    assert full == hashlib.sha256(data).hexdigest()
+
+
+def test_calculate_file_hash_blake2b(tmp_path):
+    """Test blake2b resolves to hashlib's implementation."""
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"blake content")
+    assert calculate_file_hash(str(path), "blake2b") == hashlib.blake2b(b"blake content").hexdigest()
+
+
+def test_calculate_file_hash_blake3_optional(tmp_path):
+    """Test blake3 hashes when the package is installed and fails clearly otherwise."""
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"blake content")
+    try:
+        import blake3
+    except ImportError:
+        with pytest.raises(ValueError, match="blake3"):
+            calculate_file_hash(str(path), "blake3")
+    else:
+        assert calculate_file_hash(str(path), "blake3") == blake3.blake3(b"blake content").hexdigest()
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_bounded_map_limits_in_flight(ordered):
+    """Test bounded_map never holds more than max_pending submitted tasks and returns every result."""
+    lock = threading.Lock()
+    in_flight = {"now": 0, "peak": 0}
+
+    def work(x):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        time.sleep(0.001)
+        with lock:
+            in_flight["now"] -= 1
+        return x * x
+
+    submitted = []
+    items = (submitted.append(i) or i for i in range(50))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = []
+        for result in bounded_map(executor, work, items, max_pending=3, ordered=ordered):
+            results.append(result)
+            assert len(submitted) - len(results) <= 3
+
+    assert in_flight["peak"] <= 3
+    if ordered:
+        assert results == [i * i for i in range(50)]
+    else:
+        assert sorted(results) == [i * i for i in range(50)]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_hash_files_tiered_keeps_order(tmp_path, max_workers):
+    """Test threaded hashing returns one result per path, in input order."""
+    paths = []
+    for i in range(10):
+        path = tmp_path / f"file{i}.bin"
+        path.write_bytes(os.urandom(1000 * (i + 1)))
+        paths.append(str(path))
+
+    results = list(hash_files_tiered(paths, "md5", max_workers=max_workers))
+    assert results == [calculate_file_hash_tiered(p, "md5") for p in paths]
+
+
+@pytest.mark.parametrize("file_size, max_chunk, expected", [
+    (0, 4 << 20, MIN_CHUNK_SIZE),
+    (100 * 1024, 4 << 20, MIN_CHUNK_SIZE),
+    (16 << 20, 4 << 20, 2 << 20),
+    (1 << 30, 4 << 20, 4 << 20),
+    (1 << 30, 1000, 1000),
+])
+def test_adaptive_chunk_size(file_size, max_chunk, expected):
+    """Test read size scales with file size and respects the cap."""
+    assert adaptive_chunk_size(file_size, max_chunk) == expected
+
+
 def test_calculate_file_hash_tiered_compute_full_false():
     """Test tiered hash with compute_full=False."""
     test_path = "/test/path/file.txt"
@@ -95,50 +197,85 @@ def test_calculate_file_hash_tiered_error():
         assert full.startswith("ERROR:")
 
 
-def test_group_files_by_size():
+def test_group_files_by_size(tmp_path):
     """Test grouping files by size."""
-    test_dir = "/test/dir"
-    mock_files = [
-        (1024, "/test/dir/file1.txt"),
-        (1024, "/test/dir/file2.txt"),
-        (2048, "/test/dir/file3.bin"),
-    ]
-    
-    with patch('pathlib.Path.rglob') as mock_rglob:
-        mock_path = mock_rglob.return_value
-        mock_path.is_file.return_value = True
-        mock_path.__iter__.return_value = [Path(f[1]) for f in mock_files]
-        
-        with patch('utilities.hash_calculator.get_file_size', side_effect=[f[0] for f in mock_files]):
-            groups = group_files_by_size(test_dir)
-            assert len(groups) == 1
-            assert len(groups[1024]) == 2
-            assert 2048 not in groups
-
-
-def test_calculate_directory_hashes_optimized():
-    """Test optimized directory hashing."""
-    test_dir = "/test/dir"
-    mock_files = [
-        (1024, "/test/dir/file1.txt", "tier1_a", "full_a"),
-        (1024, "/test/dir/file2.txt", "tier1_a", "full_b"),  # Same tier1, different full
-        (2048, "/test/dir/file3.bin", "tier1_b", None),  # Unique size
-    ]
-    
-    with patch('pathlib.Path.rglob') as mock_rglob:
-        mock_path = mock_rglob.return_value
-        mock_path.is_file.return_value = True
-        mock_path.__iter__.return_value = [Path(f[1]) for f in mock_files]
-        
-        with patch('utilities.hash_calculator.get_file_size', side_effect=[f[0] for f in mock_files]):
-            with patch('utilities.hash_calculator.get_file_modified_time', side_effect=[time.time() for _ in mock_files]):
-                with patch('utilities.hash_calculator.calculate_file_hash_tiered') as mock_tiered:
-                    mock_tiered.side_effect = [(f[2], f[3]) for f in mock_files]
-                    results = calculate_directory_hashes_optimized(test_dir, "md5")
-                    assert len(results) == 3
-                    # Check that full is None for unique size
-                    unique_result = next(r for r in results if r[4] == 2048)
-                    assert unique_result[3] is None
-                    # Check that full is computed for tier1 matches
-                    match_results = [r for r in results if r[4] == 1024]
-                    assert all(r[3] is not None for r in match_results)
\ No newline at end of file
+    (tmp_path / "file1.txt").write_bytes(b"x" * 1024)
+    (tmp_path / "file2.txt").write_bytes(b"y" * 1024)
+    (tmp_path / "file3.bin").write_bytes(b"z" * 2048)
+
+    groups = group_files_by_size(str(tmp_path))
+    assert len(groups) == 1
+    assert len(groups[1024]) == 2
+    assert 2048 not in groups
+
+
+def test_calculate_directory_hashes_optimized(tmp_path):
+    """Test optimized directory hashing skips unique sizes and fully hashes tier1 matches."""
+    (tmp_path / "file1.txt").write_bytes(b"a" * 1024)
+    (tmp_path / "file2.txt").write_bytes(b"a" * 1024)  # Same size, same tier1
+    (tmp_path / "file3.bin").write_bytes(b"b" * 2048)  # Unique size
+
+    real_tiered = calculate_file_hash_tiered
+    with patch('utilities.hash_calculator.calculate_file_hash_tiered', side_effect=real_tiered) as mock_tiered:
+        results = calculate_directory_hashes_optimized(str(tmp_path), "md5")
+
+    assert len(results) == 3
+    # Unique size: never opened, no tier1 and no full hash
+    unique_result = next(r for r in results if r[4] == 2048)
+    assert unique_result[2] == ''
+    assert unique_result[3] is None
+    hashed_paths = {c.args[0] for c in mock_tiered.call_args_list}
+    assert str(tmp_path / "file3.bin") not in hashed_paths
+    # Tier1 matches get a full hash
+    match_results = [r for r in results if r[4] == 1024]
+    assert all(r[3] is not None for r in match_results)
+
+
+def test_calculate_directory_hashes_optimized_tier0(tmp_path):
+    """Test files with a unique head+tail sample skip tier1; matching samples are fully hashed."""
+    size = 200 * 1024
+    base = bytearray(os.urandom(size))
+    (tmp_path / "same1.bin").write_bytes(bytes(base))
+    middle = bytearray(base)
+    middle[size // 2] ^= 0xFF  # Differs only in the middle: same head and tail
+    (tmp_path / "same2.bin").write_bytes(bytes(middle))
+    tail = bytearray(base)
+    tail[-1] ^= 0xFF  # Differs in the last byte
+    (tmp_path / "tail.bin").write_bytes(bytes(tail))
+
+    results = {os.path.basename(r[1]): r for r in calculate_directory_hashes_optimized(str(tmp_path), "md5")}
+    assert results["tail.bin"][2] == '' and results["tail.bin"][3] is None
+    assert results["same1.bin"][2] == results["same2.bin"][2] != ''
+    assert results["same1.bin"][3] == hashlib.md5(bytes(base)).hexdigest()
+    assert results["same2.bin"][3] == hashlib.md5(bytes(middle)).hexdigest()
+
+
+def test_calculate_directory_hashes_optimized_single_pool(tmp_path):
+    """Test every tier across all size groups runs on one shared thread pool."""
+    for size in (10, 20, 200 * 1024, 300 * 1024):
+        for name in ("a", "b"):
+            (tmp_path / f"{name}{size}.bin").write_bytes(b"x" * size)
+
+    # More than one thread, so hashing is not done inline and a per-group pool would show up
+    with patch('utilities.hash_calculator.HASH_THREADS', 4), \
+            patch('utilities.hash_calculator.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as mock_pool:
+        results = calculate_directory_hashes_optimized(str(tmp_path), "md5")
+
+    assert mock_pool.call_count == 1
+    assert len(results) == 8
+    assert all(r[3] is not None for r in results)
+
+
+def test_walk_files(tmp_path):
+    """Test scandir-based walk yields name, absolute path, size and mtime."""
+    (tmp_path / "a.txt").write_bytes(b"abc")
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    (sub / "b.bin").write_bytes(b"12345")
+
+    results = {name: (path, size, mtime) for name, path, size, mtime in walk_files(str(tmp_path))}
+    assert set(results) == {"a.txt", "b.bin"}
+    assert results["a.txt"][1] == 3
+    assert results["b.bin"][1] == 5
+    assert os.path.isabs(results["b.bin"][0])
+    assert results["b.bin"][2] == os.path.getmtime(sub / "b.bin")
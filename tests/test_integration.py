@@ -11,10 +11,12 @@ from utilities.database import (
     get_last_scan_timestamp,
     update_last_scan_timestamp,
     upsert_file_entry,
+    upsert_file_entries_batch,
+    HashUpdateBatcher,
     get_file_by_path,
     engine
 )
-from utilities.hash_calculator import calculate_file_hash, get_file_modified_time, get_file_size
+from utilities.hash_calculator import calculate_file_hash, get_file_modified_time, get_file_size, walk_files
 from utilities.database import engine  # For direct queries if needed
 
 
@@ -37,28 +39,6 @@ def temp_scan_dir():
         shutil.rmtree(temp_dir)
 
 
-@pytest.fixture(scope="function")
-def temp_db():
-    """Create a temporary database."""
-    db_fd, db_path = tempfile.mkstemp(suffix=".db")
-    os.close(db_fd)
-    try:
-        initialize_database(db_path)
-        yield db_path
-    finally:
-        global engine
-        if engine:
-            engine.dispose()
-        engine = None
-        import time
-        time.sleep(0.5)
-        if os.path.exists(db_path):
-            try:
-                os.unlink(db_path)
-            except PermissionError:
-                pass
-
-
 def scan_directory(temp_dir, db_path, algorithm="sha256", simulate_hash_time=False):
     """
     Simulate a full scan of the directory.
@@ -77,34 +57,30 @@ def scan_directory(temp_dir, db_path, algorithm="sha256", simulate_hash_time=Fal
     
     # Discovery: Walk and upsert metadata
     files = []
-    for root, _, filenames in os.walk(temp_dir):
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            abs_file_path = os.path.abspath(file_path)
-            file_size = get_file_size(abs_file_path)
-            modified_time = get_file_modified_time(abs_file_path)
-            scan_date = time.time()
-            files.append((filename, abs_file_path, file_size, scan_date, modified_time))
-    
-    # Upsert metadata (this will handle skipping unchanged)
-    for item in files:
-        filename, abs_path, size, scan_date, modified_time = item
-        # In real scan, this would use the batch logic, but for test, upsert directly
-        upsert_file_entry(abs_path, filename, size, modified_time, scan_date=scan_date)
-        
+    for filename, abs_file_path, file_size, modified_time in walk_files(temp_dir):
+        scan_date = time.time()
+        files.append((filename, abs_file_path, file_size, scan_date, modified_time))
+    
+    # Upsert metadata in one transaction (unchanged rows keep their hash)
+    upsert_file_entries_batch([
+        {'filename': filename, 'absolute_path': abs_path, 'file_size': size,
+         'scan_date': scan_date, 'modified_time': modified_time}
+        for filename, abs_path, size, scan_date, modified_time in files
+    ])
+    for _, abs_path, _, _, _ in files:
         # Verify stored path is absolute
         stored = get_file_by_path(abs_path)
         assert os.path.isabs(stored['absolute_path'])
+    pending = list(get_pending_files(None))
     
-    # Get pending files and hash them
-    pending = get_pending_files(None)  # conn is None, uses global engine
-    for file_id, file_path in pending:
-        assert os.path.isabs(file_path)  # Verify pending paths are absolute
-        if simulate_hash_time:
-            time.sleep(0.01)  # Simulate hashing time
-        hash_value = calculate_file_hash(file_path, algorithm)
-        update_file_hash_batch(None, [(file_id, hash_value)])
-        hashed_count += 1
+    # Hash the pending files
+    with HashUpdateBatcher() as batcher:
+        for file_id, file_path in pending:
+            assert os.path.isabs(file_path)  # Verify pending paths are absolute
+            if simulate_hash_time:
+                time.sleep(0.01)  # Simulate hashing time
+            batcher.add(file_id, calculate_file_hash(file_path, algorithm))
+            hashed_count += 1
     
     scan_time = time.time() - start_time
     update_last_scan_timestamp(time.time())
@@ -172,10 +148,11 @@ def test_integration_new_file(temp_scan_dir, temp_db):
               current_epoch, get_file_modified_time(file1_path))]
     for item in files:
         filename, abs_path, size, scan_date, modified_time = item
-        upsert_file_entry(abs_path, filename, size, modified_time, scan_date=scan_date)
+        upsert_file_entry(abs_path, filename, '', file_size=size,
+                          modified_time=modified_time, scan_date=scan_date)
         stored = get_file_by_path(abs_path)
         assert os.path.isabs(stored['absolute_path'])
-    pending = get_pending_files(None)
+    pending = list(get_pending_files(None))
     for fid, fpath in pending:
         assert os.path.isabs(fpath)
         h = calculate_file_hash(fpath)
@@ -8,7 +8,28 @@ consistent argument handling.
 """
 
 import argparse
-import multiprocessing
+import os
+
+
+# Parsers already built by parse_arguments, keyed by include_performance_options
+_PARSER_CACHE = {}
+
+_DESCRIPTION = "Scan files in a directory, calculate hashes, store in database, and generate HTML reports."
+
+_EPILOG_MULTI = """
+Examples:
+  python main_mul.py /path/to/scan -p 4  # Use 4 processes
+  python main_mul.py /path/to/scan -a sha1 -c 8MB -b 2000 -v  # Custom perf + core with verbose
+  python main_mul.py /path/to/scan -p 8 -c 8388608 -b 500  # Explicit 8MB chunk, small batches
+Note: Optimal for large scans; auto-detects CPU cores.
+"""
+
+_EPILOG_SINGLE = """
+Examples:
+  python main.py /path/to/scan  # Default settings
+  python main.py /path/to/scan -a md5 -d custom.db -r report.html -v  # Custom options with verbose output
+Note: For large directories, consider using main_mul.py for multiprocessing.
+"""
 
 
 def create_parser(include_performance_options=False):
@@ -33,27 +54,10 @@ def create_parser(include_performance_options=False):
         args = parser.parse_args()
     """
     
-    # Determine description based on mode
-    if include_performance_options:
-        description = "Scan files in a directory, calculate hashes, store in database, and generate HTML reports."
-        epilog = """
-Examples:
-  python main_mul.py /path/to/scan -p 4  # Use 4 processes
-  python main_mul.py /path/to/scan -a sha1 -c 8MB -b 2000 -v  # Custom perf + core with verbose
-  python main_mul.py /path/to/scan -p 8 -c 8388608 -b 500  # Explicit 8MB chunk, small batches
-Note: Optimal for large scans; auto-detects CPU cores.
-"""
-    else:
-        description = "Scan files in a directory, calculate hashes, store in database, and generate HTML reports."
-        epilog = """
-Examples:
-  python main.py /path/to/scan  # Default settings
-  python main.py /path/to/scan -a md5 -d custom.db -r report.html -v  # Custom options with verbose output
-Note: For large directories, consider using main_mul.py for multiprocessing.
-"""
+    epilog = _EPILOG_MULTI if include_performance_options else _EPILOG_SINGLE
     
     parser = argparse.ArgumentParser(
-        description=description,
+        description=_DESCRIPTION,
         epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -75,9 +79,11 @@ Note: For large directories, consider using main_mul.py for multiprocessing.
     
     core_group.add_argument(
         "-a", "--algorithm",
-        choices=['md5', 'sha1', 'sha256', 'sha512'],
+        choices=['md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake3'],
         default="md5",
-        help="Hashing algorithm. Possible values: %(choices)s. Default: %(default)s."
+        help="Hashing algorithm. Possible values: %(choices)s. Default: %(default)s. "
+             "blake2b and blake3 are faster than sha256 on large files (blake3 needs the blake3 package). "
+             "Rescan with the same algorithm: stored hashes are not re-computed when it changes."
     )
     
     core_group.add_argument(
@@ -103,6 +109,12 @@ Note: For large directories, consider using main_mul.py for multiprocessing.
         help="Skip HTML report generation after scanning. Useful for batch processing or when only database updates are needed."
     )
     
+    core_group.add_argument(
+        "--duplicates-only",
+        action='store_true',
+        help="Only include duplicate files in the HTML report. Keeps large reports small."
+    )
+    
     # Performance Options Group (only for multiprocessing version)
     if include_performance_options:
         perf_group = parser.add_argument_group('Performance Options')
@@ -110,7 +122,7 @@ Note: For large directories, consider using main_mul.py for multiprocessing.
         perf_group.add_argument(
             "-p", "--processes",
             type=int,
-            default=multiprocessing.cpu_count(),
+            default=os.cpu_count() or 1,
             help="Number of parallel processes for hash calculation. Use 0 for auto (CPU cores). Default: %(default)s."
         )
         
@@ -118,7 +130,7 @@ Note: For large directories, consider using main_mul.py for multiprocessing.
             "-c", "--chunk-size",
             type=int,
             default=4*1024*1024,
-            help="Buffer size for reading files during hashing (bytes). Larger values improve I/O for big files but increase memory use. Default: %(default)s (4MB). Examples: 1MB=1048576, 8MB=8388608."
+            help="Maximum buffer size for reading files during hashing (bytes). The buffer scales with each file's size (from 64KB up to this cap). Larger caps improve I/O for big files but increase memory use. Default: %(default)s (4MB). Examples: 1MB=1048576, 8MB=8388608."
         )
         
         perf_group.add_argument(
@@ -141,5 +153,10 @@ def parse_arguments(include_performance_options=False):
     Returns:
         argparse.Namespace: Parsed arguments.
     """
-    parser = create_parser(include_performance_options=include_performance_options)
+    parser = _PARSER_CACHE.get(include_performance_options)
+    if parser is None:
+        parser = _PARSER_CACHE.setdefault(
+            include_performance_options,
+            create_parser(include_performance_options=include_performance_options)
+        )
     return parser.parse_args()
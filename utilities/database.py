@@ -4,47 +4,74 @@ Database Module
 Functions for SQLite database operations using SQLAlchemy with configurable database backend.
 """
 
-import os
-from typing import List, Tuple, Optional, Dict, Any
+from typing import Iterable, Iterator, List, Tuple, Optional, Dict, Any, Mapping, Set
 from contextlib import contextmanager
+import functools
+import itertools
+import os
 import sqlite3
 import json
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Float, Table, MetaData, select, insert, inspect, case, text, Index
+import queue
+import threading
+from sqlalchemy import create_engine, event, func, Column, Integer, String, BigInteger, Table, MetaData, select, case, text, Index, or_, bindparam
 from datetime import datetime, timezone
 import time
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from urllib.parse import urlparse
 try:
     import psycopg2
 except ImportError:
     psycopg2 = None
 
-Base = declarative_base()
+class Base(DeclarativeBase):
+    pass
 
 
 class FileHash(Base):
     __tablename__ = 'file_hashes'
-    id = Column(Integer, primary_key=True)
-    filename = Column(String, nullable=False)
-    absolute_path = Column(String, nullable=False, unique=True)
-    tier1_hash = Column(String, nullable=False, default='')  # Ensure default empty string
-    hash_value = Column(String, nullable=True)
-    file_size = Column(BigInteger, nullable=False)
-    scan_date = Column(Float, nullable=False)
-    modified_time = Column(Float, nullable=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    filename: Mapped[str]
+    absolute_path: Mapped[str] = mapped_column(unique=True)
+    tier1_hash: Mapped[str] = mapped_column(default='')  # Ensure default empty string
+    hash_value: Mapped[Optional[str]]
+    file_size: Mapped[int] = mapped_column(BigInteger)
+    scan_date: Mapped[float]
+    modified_time: Mapped[Optional[float]]
     __table_args__ = (
         Index('ix_file_hashes_absolute_path', 'absolute_path'),
         Index('idx_tier1_hash', 'tier1_hash'),
+        Index('idx_hash_value', 'hash_value'),
+        # Duplicate lookups filter by size and then group by hash
+        Index('ix_size_hash', 'file_size', 'hash_value'),
+        # Partial index: only rows still awaiting a full hash, so pending lookups are O(pending)
+        Index('idx_pending', 'id', 'absolute_path',
+              sqlite_where=text("hash_value = '' OR hash_value IS NULL"),
+              postgresql_where=text("hash_value = '' OR hash_value IS NULL")),
     )
 
 
 class ScanMetadata(Base):
     __tablename__ = 'scan_metadata'
-    id = Column(Integer, primary_key=True)
-    last_scan_timestamp = Column(Float, nullable=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    last_scan_timestamp: Mapped[Optional[float]]
+
+
+# Core Table objects, built once at import and shared by every query
+_FILE_HASHES = FileHash.__table__
+_SCAN_METADATA = ScanMetadata.__table__
+
+# Prepared UPDATE shared by update_file_hash_batch
+_UPDATE_HASH_STMT = _FILE_HASHES.update().where(
+    _FILE_HASHES.c.id == bindparam('b_id')).values(hash_value=bindparam('b_hash'))
+
+# Pre-epoch view of file_hashes (scan_date as TEXT) used only by migrate_scan_date_to_epoch
+_LEGACY_FILE_HASHES = Table('file_hashes', MetaData(),
+                            Column('id', Integer, primary_key=True),
+                            Column('scan_date', String))
 
 
 def load_config() -> Dict[str, Any]:
@@ -102,56 +129,206 @@ def test_connection() -> bool:
         return False
 engine = None
 SessionFactory = None
+_engine_url = None  # URL the current engine was built from
+_init_lock = threading.Lock()
+
+STREAM_BATCH_SIZE = 1000  # Rows fetched per cursor round-trip by the streaming readers
+# Rows per executemany call in the bulk writers. Each row binds its own parameters,
+# so SQLite's per-statement variable limit does not cap this; it only bounds memory.
+WRITE_CHUNK_ROWS = 10000
+
+# Stored in SQLite's PRAGMA user_version once the schema is current (scan_date as REAL epoch,
+# all FileHash indexes present). Bump it whenever tables or indexes change so existing
+# databases go through create_all again.
+SCHEMA_VERSION = 4
+
+
+def _get_schema_version(conn) -> int:
+    """Read the schema version stamped in the SQLite header (0 if never set)."""
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+
+def _set_schema_version(conn, version: int = SCHEMA_VERSION) -> None:
+    """Stamp the schema version in the SQLite header."""
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+# SQLite allows a single writer, so one shared connection beats a pool of them
+_SQLITE_ENGINE_OPTIONS = {
+    'connect_args': {'check_same_thread': False},
+    'poolclass': StaticPool,
+}
+
+
+# psycopg2: batch executemany into multi-row VALUES (inserts) and execute_batch (updates)
+_POSTGRES_ENGINE_OPTIONS = {
+    'pool_size': 20,
+    'max_overflow': 30,
+    'executemany_mode': 'values_plus_batch',
+    'insertmanyvalues_page_size': 1000,
+    'executemany_batch_page_size': 500,
+}
+
+
+def _set_sqlite_pragma(dbapi_conn, connection_record) -> None:
+    """Connect listener: tune each pooled SQLite connection (see _apply_sqlite_pragmas)."""
+    _apply_sqlite_pragmas(dbapi_conn)
+    connection_record.info['optimized_at'] = time.monotonic()
+
+
+def _apply_sqlite_pragmas(dbapi_conn) -> None:
+    """
+    Tune a new SQLite connection for the scan workload.
+
+    WAL with synchronous=NORMAL avoids an fsync per commit; the larger page
+    cache and memory map keep index lookups off disk, and busy_timeout waits
+    for a concurrent writer instead of failing with "database is locked".
+    page_size only takes effect on a database that has no tables yet.
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA page_size=8192")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _open_dedicated_connection():
+    """
+    Open a DB-API connection outside the pool for a thread that writes while others read.
+
+    SQLite runs on a StaticPool, so every checkout shares one connection and
+    returning it to the pool rolls back any transaction another thread has open.
+    The caller owns the returned connection and must close it.
+
+    Returns:
+        A new SQLite DB-API connection, or None when pooled connections are already
+        separate (other backends) or the database is in-memory and only reachable
+        through the shared connection
+    """
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return None
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    dbapi_conn = engine.dialect.connect(*cargs, **cparams)
+    _apply_sqlite_pragmas(dbapi_conn)
+    return dbapi_conn
+
+
+# Seconds between PRAGMA optimize runs on a pooled SQLite connection
+SQLITE_OPTIMIZE_INTERVAL = 300
+
+
+def _optimize_sqlite_on_checkin(dbapi_conn, connection_record) -> None:
+    """
+    Refresh query-planner statistics when a connection returns to the pool.
+
+    PRAGMA optimize only re-analyzes tables whose indexes would benefit, and
+    runs at most once per SQLITE_OPTIMIZE_INTERVAL per connection.
+    """
+    if dbapi_conn is None:
+        return
+    now = time.monotonic()
+    if now - connection_record.info.get('optimized_at', now) < SQLITE_OPTIMIZE_INTERVAL:
+        return
+    connection_record.info['optimized_at'] = now
+    try:
+        dbapi_conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        print(f"PRAGMA optimize skipped: {e}")
 
 
 def initialize_database(db_url: str = None) -> None:
     """
     Initialize the database connection and create tables using ORM.
     Loads config from config.json if no db_url provided.
+    Thread-safe; calling it again for the same database is a no-op.
     """
-    global engine, SessionFactory
+    # Serialise initialisation so concurrent callers cannot build competing engines
+    with _init_lock:
+        _initialize_database_locked(db_url)
+
+
+def _initialize_database_locked(db_url: str = None) -> None:
+    """Body of initialize_database; caller must hold _init_lock."""
+    global engine, SessionFactory, _engine_url
 
     if db_url:
         # Override with provided URL
-        if 'postgresql' in db_url:
-            parsed = urlparse(db_url)
-            db_config = {
-                'user': parsed.username,
-                'password': parsed.password,
-                'host': parsed.hostname,
-                'port': parsed.port or 5432,
-                'database': parsed.path.lstrip('/')
-            }
-            _create_postgres_database_if_not_exists(db_url, db_config)
-            engine = create_engine(db_url, pool_size=20, max_overflow=30)
-        else:
-            engine = create_engine(db_url, connect_args={'check_same_thread': False} if 'sqlite' in db_url else {})
+        url = db_url
+        db_config = None
     else:
         config = load_config()
         db_config = config['database']
         if db_config['type'] == 'postgresql':
             url = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
-            _create_postgres_database_if_not_exists(url, db_config)
-            engine = create_engine(url, pool_size=20, max_overflow=30)
         elif db_config['type'] == 'sqlite':
             url = f"sqlite:///{db_config['path']}"
-            engine = create_engine(url, connect_args={'check_same_thread': False})
         else:
             raise ValueError(f"Unsupported database type: {db_config['type']}")
 
-    # Create tables using ORM
-    Base.metadata.create_all(engine)
+    if engine is not None:
+        if url == _engine_url:
+            return  # Already initialised for this database
+        # Switching databases: release the previous pool instead of leaking it
+        engine.dispose()
+
+    if 'postgresql' in url:
+        if db_config is None:
+            parsed = urlparse(url)
+            db_config = {
+                'user': parsed.username,
+                'password': parsed.password,
+                'host': parsed.hostname,
+                'port': parsed.port or 5432,
+                'database': parsed.path.lstrip('/')
+            }
+        _create_postgres_database_if_not_exists(url, db_config)
+        engine = create_engine(url, **_POSTGRES_ENGINE_OPTIONS)
+    else:
+        engine = create_engine(url, **(_SQLITE_ENGINE_OPTIONS if 'sqlite' in url else {}))
+    _engine_url = url
+
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, "connect", _set_sqlite_pragma)
+        event.listen(engine, "checkin", _optimize_sqlite_on_checkin)
 
-    # Migration removed. Column is now part of the ORM model definition
+    # Warm start: a current user_version means tables and indexes exist, so skip catalog checks
+    schema_current = False
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            schema_current = _get_schema_version(conn) >= SCHEMA_VERSION
 
-    # Create SessionFactory
-    SessionFactory = scoped_session(sessionmaker(bind=engine))
+    if not schema_current:
+        # Create tables using ORM
+        Base.metadata.create_all(engine)
+
+        # create_all skips indexes of tables that already exist; add any new ones to older databases
+        for index in _FILE_HASHES.indexes:
+            index.create(engine, checkfirst=True)
+
+        # Stamp databases whose scan_date is already REAL so the epoch migration is skipped cheaply
+        if engine.dialect.name == 'sqlite':
+            with engine.begin() as conn:
+                columns = conn.exec_driver_sql("PRAGMA table_info(file_hashes)").fetchall()
+                if any(col[1] == 'scan_date' and col[2].upper() in ('REAL', 'FLOAT', 'DOUBLE') for col in columns):
+                    _set_schema_version(conn)
+
+    # Create SessionFactory. Sessions are short-lived write buffers: no implicit flush
+    # before queries and objects keep their loaded values after commit (not re-read)
+    SessionFactory = scoped_session(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
 
     # Test connection
     if not test_connection():
         raise RuntimeError("Failed to connect to database")
 
 
+# SQLite predicate: scan_date holds a plain decimal number (already an epoch)
+_SQLITE_NUMERIC_TEXT = "scan_date GLOB '*[0-9]*' AND scan_date NOT GLOB '*[^0-9.]*'"
+
+
 def migrate_scan_date_to_epoch():
     """
     Migrate scan_date from TEXT datetime strings to REAL epoch floats.
@@ -160,27 +337,36 @@ def migrate_scan_date_to_epoch():
     global engine
     if not engine:
         raise RuntimeError("Database not initialized")
+
+    is_sqlite = engine.dialect.name == 'sqlite'
+    if is_sqlite:
+        with engine.connect() as conn:
+            if _get_schema_version(conn) >= SCHEMA_VERSION:
+                print("Schema already current, skipping scan_date migration.")
+                return
     
-    from datetime import datetime
-    import time
-    
-    metadata = MetaData()
-    table = Table('file_hashes', metadata,
-                  Column('id', Integer, primary_key=True),
-                  Column('scan_date', String),  # Temporary for selection
-                  extend_existing=True)
+    table = _LEGACY_FILE_HASHES
     
     with engine.connect() as conn:
-        # Fetch all rows for migration
-        select_stmt = select(table.c.id, table.c.scan_date)
-        result = conn.execute(select_stmt)
-        rows = result.fetchall()
-        
         updated_count = 0
+        select_stmt = select(table.c.id, table.c.scan_date).where(table.c.scan_date.isnot(None))
+        if is_sqlite:
+            # Convert numeric and date strings in one statement; only what SQLite
+            # cannot parse is left for the per-row Python fallback below
+            result = conn.execute(text(
+                "UPDATE file_hashes SET scan_date = CASE "
+                f"WHEN {_SQLITE_NUMERIC_TEXT} THEN CAST(scan_date AS REAL) "
+                "ELSE strftime('%s', scan_date) + 0.0 END "
+                f"WHERE scan_date IS NOT NULL AND ({_SQLITE_NUMERIC_TEXT} OR strftime('%s', scan_date) IS NOT NULL)"
+            ))
+            updated_count += result.rowcount
+            select_stmt = select_stmt.where(text(f"NOT ({_SQLITE_NUMERIC_TEXT})"))
+        
+        # Fetch remaining rows for migration
+        rows = conn.execute(select_stmt).fetchall()
+        
         for row in rows:
             scan_date_str = row.scan_date
-            if scan_date_str is None:
-                continue
             
             try:
                 # First, try if already numeric (epoch string)
@@ -218,53 +404,77 @@ def migrate_scan_date_to_epoch():
             # Rename new to old
             conn.execute(text("ALTER TABLE file_hashes RENAME COLUMN scan_date_new TO scan_date"))
             
+            if is_sqlite:
+                _set_schema_version(conn)
+            
             print("Schema updated: scan_date column now REAL.")
         except Exception as e:
             print(f"Schema update failed: {e}. Data migration applied, but column remains TEXT. Retrieval functions will handle casting.")
-def save_to_database(conn: sqlite3.Connection, file_data: List[Tuple]) -> None:
+def save_to_database(conn: sqlite3.Connection, file_data: Iterable[Tuple]) -> None:
     """
     Save file data to database (Legacy function, use upsert_files instead).
     
     Args:
         conn: SQLite connection object
-        file_data: List of tuples (filename, absolute_path, hash_value, file_size, scan_date) where scan_date is epoch float
+        file_data: Iterable of tuples (filename, absolute_path, hash_value, file_size, scan_date) where scan_date is epoch float
     """
     global engine
     if not engine:
         raise RuntimeError("Database not initialized")
 
-    data_dicts = [
-        {
-            'filename': item[0],
-            'absolute_path': item[1],
-            'hash_value': item[2],
-            'file_size': item[3],
-            'scan_date': item[4]
-        }
-        for item in file_data
-    ]
-    
-    metadata = MetaData()
-    table = Table('file_hashes', metadata,
-                 Column('id', Integer, primary_key=True),
-                 Column('filename', String),
-                 Column('absolute_path', String, unique=True),
-                 Column('hash_value', String),
-                 Column('file_size', BigInteger),
-                 Column('scan_date', Float),
-                 Column('modified_time', Float))
+    _executemany(_save_stmt(engine.dialect.name), file_data, WRITE_CHUNK_ROWS,
+                 columns=('filename', 'absolute_path', 'hash_value', 'file_size', 'scan_date'))
 
-    with engine.begin() as connection:
-        for chunk in _chunk_data(data_dicts, 1000):
-            # Use INSERT OR REPLACE logic
-            for item in chunk:
-                try:
-                    stmt = insert(table).values(**item)
-                    connection.execute(stmt)
-                except:
-                    # Update existing
-                    stmt = table.update().where(table.c.absolute_path == item['absolute_path']).values(**item)
-                    connection.execute(stmt)
+
+@functools.lru_cache(maxsize=None)
+def _save_stmt(dialect_name: str):
+    """Build (once per dialect) the upsert used by save_to_database."""
+    table = _FILE_HASHES
+    stmt = _dialect_insert(table, dialect_name)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.absolute_path],
+        set_={key: stmt.excluded[key] for key in ('filename', 'hash_value', 'file_size', 'scan_date')}
+    )
+
+
+def iter_all_records(batch_size: int = STREAM_BATCH_SIZE, order_by_hash: bool = False) -> Iterator[Tuple]:
+    """
+    Stream all records from the database.
+
+    Args:
+        batch_size: Rows fetched from the cursor per round-trip
+        order_by_hash: Return files with the same hash_value next to each other
+
+    Yields:
+        (filename, absolute_path, hash_value, file_size, scan_date) rows
+    """
+    sql = "SELECT filename, absolute_path, hash_value, file_size, scan_date FROM file_hashes"
+    if order_by_hash:
+        sql += " ORDER BY hash_value"
+    # Plain driver rows: no ORM identity map or per-row attribute access
+    with engine.connect().execution_options(stream_results=True, yield_per=batch_size) as connection:
+        yield from connection.exec_driver_sql(sql)
+
+
+def iter_duplicate_records(batch_size: int = STREAM_BATCH_SIZE) -> Iterator[Tuple]:
+    """
+    Stream only records whose full hash is shared by another file, grouped by hash.
+
+    Args:
+        batch_size: Rows fetched from the cursor per round-trip
+
+    Yields:
+        (filename, absolute_path, hash_value, file_size, scan_date) rows ordered by hash_value
+    """
+    sql = (
+        "SELECT filename, absolute_path, hash_value, file_size, scan_date FROM file_hashes "
+        "WHERE hash_value IN ("
+        "SELECT hash_value FROM file_hashes WHERE hash_value != '' "
+        "GROUP BY hash_value HAVING COUNT(*) > 1"
+        ") ORDER BY hash_value"
+    )
+    with engine.connect().execution_options(stream_results=True, yield_per=batch_size) as connection:
+        yield from connection.exec_driver_sql(sql)
 
 
 def get_all_records(conn: sqlite3.Connection = None) -> List[Tuple]:
@@ -275,21 +485,26 @@ def get_all_records(conn: sqlite3.Connection = None) -> List[Tuple]:
         conn: Ignored, kept for backward compatibility
 
     Returns:
-        List of tuples containing all file records
+        List of tuples containing all file records (see iter_all_records to stream them)
     """
-    with get_session() as session:
-        files = session.query(FileHash).all()
-        return [(f.filename, f.absolute_path, f.hash_value, f.file_size, f.scan_date) for f in files]
+    return list(iter_all_records())
 
 def _chunk_data(data, chunk_size):
-    """Split data into chunks of specified size for batch processing."""
-    for i in range(0, len(data), chunk_size):
-        yield data[i:i + chunk_size]
+    """Split any iterable into lists of at most chunk_size items, consuming it lazily."""
+    it = iter(data)
+    while chunk := list(itertools.islice(it, chunk_size)):
+        yield chunk
 
 # Context manager for session handling (useful for scripts that need direct session access)
 @contextmanager
 def get_session():
-    """Context manager for handling SQLAlchemy sessions."""
+    """
+    Context manager for handling SQLAlchemy sessions.
+
+    Sessions do not autoflush and do not expire objects on commit, so attribute
+    reads after the block return the values loaded or set inside it; call
+    session.flush() before a query that must see pending changes.
+    """
     if not SessionFactory:
         raise RuntimeError("Database not initialized. Call initialize_database first.")
     
@@ -303,109 +518,431 @@ def get_session():
     finally:
         session.close()
 
-def upsert_files(conn: sqlite3.Connection, file_data: List[Tuple]) -> None:
+def upsert_files(conn: sqlite3.Connection, file_data: Iterable[Tuple]) -> None:
     """
     Insert new files or update existing ones.
-    If a file exists but size changed, reset hashes to NULL/empty.
+    If a file exists but size or modified_time changed, its stored hashes are replaced
+    by the supplied ones (hash_value becomes '' when no full hash was supplied).
+
+    Uses one native INSERT ... ON CONFLICT DO UPDATE statement executed with
+    executemany per chunk (on the raw DB-API cursor for SQLite), so no
+    existence SELECT is needed.
 
-    All paths in file_data must use full root-relative absolute paths.
+    Relative paths in file_data are stored as absolute paths (resolved against the
+    current working directory).
 
     Args:
-        conn: Ignored
-        file_data: List of tuples (filename, absolute_path, tier1_hash, hash_value, file_size, scan_date, modified_time)
-    """
-    with get_session() as session:
-        for filename, abs_path, tier1_hash, hash_value, file_size, scan_date, modified_time in file_data:
-            # Check if exists
-            existing = session.query(FileHash).filter_by(absolute_path=abs_path).first()
-            if existing:
-                if existing.file_size != file_size or existing.modified_time != modified_time:
-                    # Changed, reset hashes
-                    existing.hash_value = ''
-                    existing.tier1_hash = tier1_hash  # Update tier1 if changed
-                else:
-                    # Unchanged, keep existing hashes if valid
-                    if not existing.tier1_hash:
-                        existing.tier1_hash = tier1_hash
-                    if hash_value and not existing.hash_value:
-                        existing.hash_value = hash_value
-                existing.filename = filename
-                existing.file_size = file_size
-                existing.scan_date = scan_date
-                existing.modified_time = modified_time
-            else:
-                # New
-                new_file = FileHash(
-                    filename=filename,
-                    absolute_path=abs_path,
-                    tier1_hash=tier1_hash,
-                    hash_value=hash_value or '',
-                    file_size=file_size,
-                    scan_date=scan_date,
-                    modified_time=modified_time
-                )
-                session.add(new_file)
-
-def get_pending_files(conn: sqlite3.Connection = None) -> List[Tuple]:
-    """Get all files that have no full hash (tier1 may be present)."""
-    with get_session() as session:
-        files = session.query(FileHash).filter((FileHash.hash_value == '') | (FileHash.hash_value == None)).all()
-        return [(f.id, f.absolute_path) for f in files]
+        conn: DB-API connection to write through instead of a pooled one (SQLite only,
+              see _open_dedicated_connection); None uses the engine
+        file_data: Iterable of tuples (filename, absolute_path, tier1_hash, hash_value, file_size, scan_date, modified_time)
+    """
+    rows = (
+        {
+            'filename': filename,
+            'absolute_path': _absolute_path(abs_path),
+            'tier1_hash': tier1_hash or '',
+            'hash_value': hash_value or '',
+            'file_size': file_size,
+            'scan_date': scan_date,
+            'modified_time': modified_time
+        }
+        for filename, abs_path, tier1_hash, hash_value, file_size, scan_date, modified_time in file_data
+    )
+    _executemany(_upsert_files_stmt(engine.dialect.name), rows, WRITE_CHUNK_ROWS, dbapi_conn=conn)
+
+
+@functools.lru_cache(maxsize=None)
+def _upsert_files_stmt(dialect_name: str):
+    """Build (once per dialect) the upsert used by upsert_files."""
+    table = _FILE_HASHES
+    stmt = _dialect_insert(table, dialect_name)
+    excluded = stmt.excluded
+    changed = or_(table.c.file_size != excluded.file_size,
+                  table.c.modified_time.is_distinct_from(excluded.modified_time))
+    missing_hash = or_(table.c.hash_value.is_(None), table.c.hash_value == '')
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.absolute_path],
+        set_={
+            'filename': excluded.filename,
+            # Changed content takes the new hashes; unchanged rows only fill in missing ones
+            'tier1_hash': case((or_(changed, table.c.tier1_hash == ''), excluded.tier1_hash),
+                               else_=table.c.tier1_hash),
+            'hash_value': case((or_(changed, missing_hash), excluded.hash_value),
+                               else_=table.c.hash_value),
+            'file_size': excluded.file_size,
+            'scan_date': excluded.scan_date,
+            'modified_time': excluded.modified_time
+        }
+    )
+
+def get_pending_files(conn: sqlite3.Connection = None) -> Iterator[Tuple]:
+    """
+    Stream (id, absolute_path) of files that have no full hash (tier1 may be present).
+
+    Wrap in list() before writing hashes back while iterating.
+    """
+    # Literal predicate matches idx_pending; either it or idx_hash_value serves the lookup
+    with engine.connect().execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE) as connection:
+        yield from connection.exec_driver_sql(
+            "SELECT id, absolute_path FROM file_hashes WHERE hash_value = '' OR hash_value IS NULL"
+        )
 
 def update_file_hash(conn: sqlite3.Connection, file_id: int, hash_value: str) -> None:
     """Update the hash for a specific file ID."""
-    with get_session() as session:
-        file = session.query(FileHash).filter_by(id=file_id).first()
-        if file:
-            file.hash_value = hash_value
+    table = _FILE_HASHES
+    with engine.begin() as connection:
+        connection.execute(table.update().where(table.c.id == file_id).values(hash_value=hash_value))
 
 def update_file_hash_batch(conn: sqlite3.Connection, updates: List[Tuple[int, str]]) -> None:
-    """Update hashes for a batch of files (id, hash)."""
-    with get_session() as session:
-        for file_id, hash_val in updates:
-            file = session.query(FileHash).filter_by(id=file_id).first()
-            if file:
-                file.hash_value = hash_val
+    """
+    Update hashes for a batch of files (id, hash).
+
+    One prepared UPDATE is executed with executemany per chunk inside a single transaction.
+    """
+    if not updates:
+        return
+    _executemany(_UPDATE_HASH_STMT, [{'b_id': file_id, 'b_hash': hash_val} for file_id, hash_val in updates], WRITE_CHUNK_ROWS)
+
+
+class HashUpdateBatcher:
+    """
+    Accumulate (id, hash) updates and write them with update_file_hash_batch.
+
+    Use instead of calling update_file_hash once per file: updates are flushed
+    every flush_every items and on exit, so N hashes cost N/flush_every commits.
+
+    Example:
+        with HashUpdateBatcher() as batcher:
+            for file_id, path in pending:
+                batcher.add(file_id, calculate_file_hash(path))
+    """
+
+    def __init__(self, flush_every: int = 500):
+        self.flush_every = flush_every
+        self.buffer: List[Tuple[int, str]] = []
+
+    def add(self, file_id: int, hash_value: str) -> None:
+        """Queue one update, flushing when the buffer is full."""
+        self.buffer.append((file_id, hash_value))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all queued updates in one transaction."""
+        if self.buffer:
+            update_file_hash_batch(None, self.buffer)
+            self.buffer.clear()
+
+    def __enter__(self) -> "HashUpdateBatcher":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.flush()
+
+
+class DBWriter(threading.Thread):
+    """
+    Background thread that writes upsert_files tuples as they are produced.
+
+    Producers put (filename, absolute_path, tier1_hash, hash_value, file_size,
+    scan_date, modified_time) tuples on a bounded queue; the thread upserts them
+    in chunks of flush_every, or after flush_interval seconds when producers are
+    slow (e.g. hashing large files). Hashing overlaps with database I/O and memory
+    stays bounded by the queue size instead of the number of files. On SQLite the
+    thread writes through its own connection, so other threads may keep reading
+    the database while it flushes.
+
+    Example:
+        with DBWriter() as writer:
+            for item in scanned_files:
+                writer.put(item)
+    """
+
+    def __init__(self, flush_every: int = WRITE_CHUNK_ROWS, maxsize: int = 50000,
+                 flush_interval: Optional[float] = 1.0):
+        super().__init__(name="DBWriter", daemon=True)
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.error: Optional[BaseException] = None
+
+    def put(self, item: Tuple) -> None:
+        """Queue one row, blocking while the queue is full."""
+        self.queue.put(item)
+
+    def run(self) -> None:
+        # Not the shared StaticPool connection: a reader returning it to the pool
+        # would roll back this thread's uncommitted batch
+        connection = None
+        try:
+            connection = _open_dedicated_connection()
+        except Exception as e:
+            self.error = e
+        try:
+            self._write_queued(connection)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _write_queued(self, connection) -> None:
+        """Upsert queued rows in batches until the None sentinel arrives."""
+        buffer = []
+        flush_at = None  # Deadline for the oldest buffered row
+        while True:
+            timeout = None if flush_at is None else max(0.0, flush_at - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+                timed_out = False
+            except queue.Empty:
+                item, timed_out = None, True
+            if item is not None:
+                if not buffer and self.flush_interval is not None:
+                    flush_at = time.monotonic() + self.flush_interval
+                buffer.append(item)
+            if item is None or len(buffer) >= self.flush_every:
+                # After a failure keep draining so producers never block on a full queue
+                if buffer and self.error is None:
+                    try:
+                        upsert_files(connection, buffer)
+                    except Exception as e:
+                        self.error = e
+                buffer.clear()
+                flush_at = None
+                if item is None and not timed_out:
+                    return
+
+    def close(self) -> None:
+        """Flush remaining rows, stop the thread and re-raise any write error."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "DBWriter":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def get_duplicates(min_size: int = 0) -> List[Tuple[str, int]]:
+    """
+    Find full hashes shared by more than one file, aggregated in the database.
+
+    Args:
+        min_size: Only consider files of at least this many bytes
+
+    Returns:
+        List of (hash_value, file_count) tuples; unhashed files are ignored
+    """
+    table = _FILE_HASHES
+    file_count = func.count()
+    query = select(table.c.hash_value, file_count).where(
+        table.c.file_size >= min_size,
+        table.c.hash_value.isnot(None),
+        table.c.hash_value != ''
+    ).group_by(table.c.hash_value).having(file_count > 1)
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(query)]
+
+
+def get_shared_sizes() -> Set[int]:
+    """
+    Find file sizes held by more than one stored file.
+
+    Only files of these sizes can have duplicates; the grouping runs in the
+    database over the ix_size_hash index instead of in Python.
+
+    Returns:
+        Set of file sizes (bytes) with two or more rows
+    """
+    table = _FILE_HASHES
+    query = select(table.c.file_size).group_by(table.c.file_size).having(func.count() > 1)
+    with engine.connect() as connection:
+        return set(connection.execute(query).scalars())
+
+
+def _load_scan_paths(connection, paths: Iterable[str]) -> None:
+    """Replace the contents of the __scan_paths temporary table (SQLite only) with paths."""
+    connection.exec_driver_sql("CREATE TEMP TABLE IF NOT EXISTS __scan_paths(p TEXT PRIMARY KEY)")
+    connection.exec_driver_sql("DELETE FROM __scan_paths")
+    connection.exec_driver_sql("INSERT OR IGNORE INTO __scan_paths(p) VALUES (?)", [(p,) for p in paths])
+
+
+def _select_for_paths(query, paths: Optional[List[str]]) -> List[Tuple]:
+    """
+    Run a file_hashes query, optionally restricted to rows whose absolute_path is in paths.
+
+    On SQLite the paths are joined through the __scan_paths temporary table;
+    other backends run the query once per chunk of 900 paths with IN.
+    """
+    if paths is not None and not paths:
+        return []
+    absolute_path = _FILE_HASHES.c.absolute_path
+    with engine.connect() as connection:
+        if paths is None:
+            return [tuple(row) for row in connection.execute(query)]
+        if engine.dialect.name == 'sqlite':
+            _load_scan_paths(connection, paths)
+            scan_paths = text("SELECT p FROM __scan_paths").columns(p=String)
+            return [tuple(row) for row in connection.execute(query.where(absolute_path.in_(scan_paths)))]
+        rows = []
+        for chunk_paths in _chunk_data(paths, 900):
+            rows.extend(tuple(row) for row in connection.execute(query.where(absolute_path.in_(chunk_paths))))
+        return rows
+
+
+def get_files_needing_tier1(paths: Optional[List[str]] = None) -> List[Tuple]:
+    """
+    Find stored files without a tier1 hash whose size another stored file shares.
+
+    This covers files just recorded as pending and settled unique-size files that
+    a new file now shares a size with; a file whose size nobody else has is never
+    opened.
+
+    Args:
+        paths: Absolute paths found by the current scan; only these rows are returned,
+               so files under other scan roots or no longer on disk are not reopened.
+               Sizes are still compared against every stored file. None returns all rows.
+
+    Returns:
+        List of (filename, absolute_path, file_size, scan_date, modified_time) tuples
+    """
+    table = _FILE_HASHES
+    shared_sizes = select(table.c.file_size).group_by(table.c.file_size).having(func.count() > 1)
+    query = select(table.c.filename, table.c.absolute_path, table.c.file_size,
+                   table.c.scan_date, table.c.modified_time).where(
+        or_(table.c.tier1_hash.is_(None), table.c.tier1_hash == ''),
+        table.c.file_size.in_(shared_sizes)
+    )
+    return _select_for_paths(query, paths)
+
+
+def get_full_hash_candidates(paths: Optional[List[str]] = None) -> List[Tuple]:
+    """
+    Find stored files without a full hash whose size and tier1 hash collide with another file.
+
+    Both sides of a collision are returned when neither has a full hash yet, so a
+    settled file is pulled back for hashing only when a new file matches it.
+
+    Args:
+        paths: Absolute paths found by the current scan; only these rows are returned,
+               while the colliding file may be any stored row. None returns all rows.
+
+    Returns:
+        List of (filename, absolute_path, tier1_hash, file_size, scan_date, modified_time) tuples
+    """
+    table = _FILE_HASHES
+    other = table.alias('other')
+    collides = select(other.c.id).where(
+        other.c.file_size == table.c.file_size,
+        other.c.tier1_hash == table.c.tier1_hash,
+        other.c.id != table.c.id
+    ).exists()
+    query = select(table.c.filename, table.c.absolute_path, table.c.tier1_hash, table.c.file_size,
+                   table.c.scan_date, table.c.modified_time).where(
+        or_(table.c.hash_value.is_(None), table.c.hash_value == ''),
+        table.c.tier1_hash != '',
+        collides
+    )
+    return _select_for_paths(query, paths)
 
 
 def get_last_scan_timestamp() -> Optional[float]:
     """
     Get the last scan timestamp from the database.
     """
-    with get_session() as session:
-        meta = session.query(ScanMetadata).first()
-        return meta.last_scan_timestamp if meta else None
+    query = select(_SCAN_METADATA.c.last_scan_timestamp).limit(1)
+    with engine.connect() as connection:
+        return connection.execute(query).scalar()
 
 
 def update_last_scan_timestamp(timestamp: float) -> None:
     """
     Update or insert the last scan timestamp in the database.
+
+    The single metadata row (id=1) is written with one INSERT ... ON CONFLICT DO UPDATE.
     """
-    with get_session() as session:
-        meta = session.query(ScanMetadata).first()
-        if meta:
-            meta.last_scan_timestamp = timestamp
-        else:
-            new_meta = ScanMetadata(id=1, last_scan_timestamp=timestamp)
-            session.add(new_meta)
+    table = _SCAN_METADATA
+    stmt = _dialect_insert(table).values(id=1, last_scan_timestamp=timestamp)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={'last_scan_timestamp': stmt.excluded.last_scan_timestamp}
+    )
+    with engine.begin() as connection:
+        connection.execute(stmt)
 
 
-def get_file_by_path(absolute_path: str) -> Optional[Dict[str, Any]]:
+def has_tier1_match(file_size: int, tier1_hash: str, exclude_path: Optional[str] = None) -> bool:
+    """
+    Check whether any stored file shares a size and tier1 hash.
+
+    Args:
+        file_size: File size in bytes
+        tier1_hash: Tier1 hash to look for
+        exclude_path: Absolute path whose own row must not count as a match
+
+    Returns:
+        True if a matching row with a non-NULL hash_value exists
+    """
+    table = _FILE_HASHES
+    query = select(table.c.id).where(
+        table.c.file_size == file_size,
+        table.c.tier1_hash == tier1_hash,
+        table.c.hash_value.isnot(None)
+    )
+    if exclude_path is not None:
+        query = query.where(table.c.absolute_path != exclude_path)
+    query = query.limit(1)
+    with engine.connect() as connection:
+        return connection.execute(query).first() is not None
+
+
+def get_file_by_path(absolute_path: str) -> Optional[Mapping[str, Any]]:
     """
     Get file metadata by absolute path.
+
+    Returns a read-only row mapping keyed by column name (e.g. result['hash_value']).
     """
-    with get_session() as session:
-        file = session.query(FileHash).filter_by(absolute_path=absolute_path).first()
-        if file:
-            return {
-                'filename': file.filename,
-                'absolute_path': file.absolute_path,
-                'hash_value': file.hash_value,
-                'file_size': file.file_size,
-                'scan_date': file.scan_date,
-                'modified_time': file.modified_time
-            }
-        return None
+    query = select(FileHash.filename, FileHash.absolute_path, FileHash.hash_value,
+                   FileHash.file_size, FileHash.scan_date, FileHash.modified_time).where(
+        FileHash.absolute_path == absolute_path)
+    with engine.connect() as connection:
+        row = connection.execute(query).first()
+    return row._mapping if row is not None else None
+
+
+def get_files_by_paths(paths: List[str]) -> Dict[str, Mapping[str, Any]]:
+    """
+    Get stored metadata for many absolute paths at once.
+
+    On SQLite the paths are loaded into a temporary table and joined against
+    file_hashes, so one SELECT serves any number of paths; other backends
+    query in chunks of 900 with IN.
+
+    Returns:
+        Dict mapping absolute_path -> row mapping (file_size, hash_value,
+        tier1_hash, modified_time, scan_date); unknown paths are omitted
+    """
+    if not paths:
+        return {}
+    table = _FILE_HASHES
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            _load_scan_paths(connection, paths)
+            rows = connection.exec_driver_sql(
+                "SELECT f.absolute_path, f.file_size, f.hash_value, f.tier1_hash, f.modified_time, f.scan_date "
+                "FROM file_hashes f JOIN __scan_paths s ON f.absolute_path = s.p"
+            ).fetchall()
+        else:
+            rows = []
+            for chunk_paths in _chunk_data(paths, 900):
+                query = select(table.c.absolute_path, table.c.file_size, table.c.hash_value,
+                               table.c.tier1_hash, table.c.modified_time, table.c.scan_date).where(
+                    table.c.absolute_path.in_(chunk_paths))
+                rows.extend(connection.execute(query))
+    return {row.absolute_path: row._mapping for row in rows}
 
 
 def is_file_unchanged(absolute_path: str, current_modified_time: float) -> bool:
@@ -422,54 +959,249 @@ def is_file_unchanged(absolute_path: str, current_modified_time: float) -> bool:
     Returns:
         True if unchanged (can reuse hash), False otherwise.
     """
-    file_info = get_file_by_path(absolute_path)
-    if not file_info or file_info['modified_time'] is None:
+    # Last scan timestamp is read once and compared as a scalar, as in is_file_unchanged_bulk.
+    # No row (or no previous scan / no stored modified_time) means the file must be hashed.
+    last_scan_ts = get_last_scan_timestamp()
+    if last_scan_ts is None:
         return False
-    
+    query = select(FileHash.id).where(
+        FileHash.absolute_path == absolute_path,
+        FileHash.modified_time >= last_scan_ts,
+        FileHash.modified_time >= current_modified_time
+    ).limit(1)
+    with engine.connect() as connection:
+        return connection.execute(query).first() is not None
+
+
+def is_file_unchanged_bulk(paths_mtimes: List[Tuple[str, float]]) -> Set[str]:
+    """
+    Batch variant of is_file_unchanged.
+
+    Args:
+        paths_mtimes: List of (absolute_path, current_modified_time) pairs.
+
+    Returns:
+        Set of absolute paths that are unchanged since the last scan.
+    """
     last_scan_ts = get_last_scan_timestamp()
     if last_scan_ts is None:
-        return False  # No previous scan, must hash
-    
-    # Check if stored modified_time is from last scan and current <= stored
-    return (file_info['modified_time'] >= last_scan_ts and current_modified_time <= file_info['modified_time'])
+        return set()
+    current = dict(paths_mtimes)
+    # Last scan timestamp is read once; stored rows come from a single temp-table join
+    return {
+        path for path, stored in get_files_by_paths(list(current)).items()
+        if stored['modified_time'] is not None
+        and stored['modified_time'] >= last_scan_ts
+        and current[path] <= stored['modified_time']
+    }
 
 
 # Migration function removed. Column is now part of the ORM model definition
 
 
+def _dialect_insert(table: Table, dialect_name: str = None):
+    """Return an INSERT construct supporting ON CONFLICT for the given (default: active) backend."""
+    if (dialect_name or engine.dialect.name) == 'postgresql':
+        return pg_insert(table)
+    return sqlite_insert(table)
+
+
+def _absolute_path(path: str) -> str:
+    """Return path made absolute; already absolute paths (what scanners pass) are returned as is."""
+    return path if os.path.isabs(path) else os.path.abspath(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_for_executemany(stmt, column_keys: Tuple[str, ...]) -> Tuple[str, List[str], Dict[str, Any]]:
+    """
+    Compile a statement for SQLite once per (statement, parameter keys).
+
+    Returns:
+        (sql, positional parameter names, values of literal bound parameters)
+    """
+    compiled = stmt.compile(dialect=engine.dialect, column_keys=list(column_keys))
+    # Literals inside the statement (e.g. '' in CASE) are bound parameters too
+    constants = dict(compiled.params)
+    # Columns left out of the rows get their scalar Python-side defaults (e.g. tier1_hash='')
+    for column in compiled.insert_prefetch:
+        if column.default is not None and column.default.is_scalar:
+            constants[column.key] = column.default.arg
+    return compiled.string, compiled.positiontup, constants
+
+
+def _executemany(stmt, rows: Iterable, chunk_size: int, columns: Tuple[str, ...] = None,
+                 dbapi_conn=None) -> None:
+    """
+    Execute one statement for many parameter rows in a single transaction.
+
+    On SQLite the statement is compiled once and handed straight to the DB-API
+    cursor's executemany, skipping SQLAlchemy's per-row parameter handling
+    (none of the file_hashes column types need bind processing there).
+    Other backends go through Connection.execute.
+
+    Args:
+        stmt: Statement to execute
+        rows: Parameter dicts, or tuples ordered as ``columns`` when given
+        chunk_size: Number of rows per executemany call
+        columns: Column names of tuple rows; tuples already in the compiled
+                 parameter order are passed to SQLite without any copying
+        dbapi_conn: SQLite connection to use (and leave open) instead of a pooled one
+    """
+    chunks = _chunk_data(rows, chunk_size)
+    first = next(chunks, None)
+    if first is None:
+        return
+    chunks = itertools.chain([first], chunks)
+
+    if engine.dialect.name != 'sqlite':
+        with engine.begin() as connection:
+            for chunk in chunks:
+                if columns:
+                    chunk = [dict(zip(columns, row)) for row in chunk]
+                connection.execute(stmt, chunk)
+        return
+
+    sql, keys, constants = _compile_for_executemany(stmt, columns or tuple(first[0]))
+    if columns:
+        if tuple(keys) == columns:
+            to_params = lambda chunk: chunk
+        else:
+            positions = [columns.index(k) if k in columns else None for k in keys]
+            to_params = lambda chunk: [
+                tuple(row[i] if i is not None else constants[k] for i, k in zip(positions, keys)) for row in chunk]
+    else:
+        to_params = lambda chunk: [tuple(row[k] if k in row else constants[k] for k in keys) for row in chunk]
+
+    raw = dbapi_conn if dbapi_conn is not None else engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for chunk in chunks:
+            cursor.executemany(sql, to_params(chunk))
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        if dbapi_conn is None:
+            raw.close()
+
+
+def upsert_file_entries_batch(entries: Iterable[Dict[str, Any]], batch_size: int = WRITE_CHUNK_ROWS) -> None:
+    """
+    Upsert many file entries in one transaction.
+
+    Batch counterpart of upsert_file_entry: a single INSERT ... ON CONFLICT DO UPDATE
+    is executed with executemany per chunk. The stored hash is kept when file_size and
+    modified_time match and reset to '' otherwise, unless the entry supplies a hash_value.
+    scan_date is refreshed on every row, so scanners can use it to mark unchanged files as seen.
+    Relative paths are stored as absolute paths.
+
+    Args:
+        entries: Dicts with absolute_path, filename, file_size, modified_time and
+                 optionally tier1_hash, hash_value and scan_date
+        batch_size: Number of rows per executemany call
+    """
+    current_scan_date = time.time()
+    rows = (
+        {
+            'filename': entry['filename'],
+            'absolute_path': _absolute_path(entry['absolute_path']),
+            'tier1_hash': entry.get('tier1_hash') or '',
+            'hash_value': entry.get('hash_value') or '',
+            'file_size': entry['file_size'],
+            'scan_date': entry.get('scan_date') or current_scan_date,
+            'modified_time': entry['modified_time']
+        }
+        for entry in entries
+    )
+    _executemany(_upsert_entries_stmt(engine.dialect.name), rows, batch_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _upsert_entries_stmt(dialect_name: str):
+    """Build (once per dialect) the upsert used by upsert_file_entries_batch."""
+    table = _FILE_HASHES
+    stmt = _dialect_insert(table, dialect_name)
+    excluded = stmt.excluded
+    metadata_changed = or_(table.c.file_size != excluded.file_size,
+                           table.c.modified_time.is_distinct_from(excluded.modified_time))
+    has_new_hash = excluded.hash_value != ''
+    has_new_tier1 = excluded.tier1_hash != ''
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.absolute_path],
+        set_={
+            'filename': excluded.filename,
+            'tier1_hash': case((has_new_tier1, excluded.tier1_hash),
+                               (metadata_changed, ''),
+                               else_=table.c.tier1_hash),
+            'hash_value': case((has_new_hash, excluded.hash_value),
+                               (metadata_changed, ''),
+                               else_=table.c.hash_value),
+            'file_size': excluded.file_size,
+            'scan_date': excluded.scan_date,
+            'modified_time': excluded.modified_time
+        }
+    )
+
+
 def upsert_file_entry(absolute_path: str, filename: str, tier1_hash: str, hash_value: str = None,
-                      file_size: int = None, modified_time: float = None, scan_date: float = None) -> None:
+                      file_size: int = None, modified_time: float = None,
+                      scan_date: float = None) -> Optional[Tuple[int, str, str]]:
     """
     Upsert a file entry with metadata including tier1_hash.
+
+    Uses a single INSERT ... ON CONFLICT DO UPDATE. The hash is reset to '' when
+    size or modified_time changed, unless a new hash_value is supplied. As in
+    upsert_file_entries_batch, scan_date is refreshed on every call, so scanners can
+    use it to mark unchanged files as seen.
+    A relative absolute_path is stored as an absolute path.
+
+    Returns:
+        (id, absolute_path, hash_value) of the inserted/updated row via RETURNING,
+        or None if the backend lacks RETURNING support.
+        A returned hash_value of '' means the file needs hashing, so scanners can
+        queue it without a separate get_pending_files query.
     """
-    with get_session() as session:
-        current_scan_date = scan_date if scan_date is not None else time.time()
-
-        existing = session.query(FileHash).filter_by(absolute_path=absolute_path).first()
-        if existing:
-            if file_size is not None and existing.file_size != file_size:
-                existing.hash_value = ''
-            if tier1_hash:
-                existing.tier1_hash = tier1_hash
-            if hash_value is not None:
-                existing.hash_value = hash_value
-            if filename:
-                existing.filename = filename
-            if file_size is not None:
-                existing.file_size = file_size
-            existing.scan_date = current_scan_date
-            if modified_time is not None:
-                existing.modified_time = modified_time
-        else:
-            new_hash = hash_value if hash_value is not None else ''
-            new_file = FileHash(
-                filename=filename,
-                absolute_path=absolute_path,
-                tier1_hash=tier1_hash,
-                hash_value=new_hash,
-                file_size=file_size,
-                scan_date=current_scan_date,
-                modified_time=modified_time
-            )
-            session.add(new_file)
+    table = _FILE_HASHES
+    current_scan_date = scan_date if scan_date is not None else time.time()
+
+    stmt = _dialect_insert(table).values(
+        filename=filename,
+        absolute_path=_absolute_path(absolute_path),
+        tier1_hash=tier1_hash or '',
+        hash_value=hash_value if hash_value is not None else '',
+        file_size=file_size,
+        scan_date=current_scan_date,
+        modified_time=modified_time
+    )
+    excluded = stmt.excluded
+
+    set_ = {'scan_date': excluded.scan_date}
+    metadata_changed = []
+    if file_size is not None:
+        set_['file_size'] = excluded.file_size
+        metadata_changed.append(table.c.file_size != excluded.file_size)
+    if modified_time is not None:
+        set_['modified_time'] = excluded.modified_time
+        metadata_changed.append(table.c.modified_time.is_distinct_from(excluded.modified_time))
 
+    if hash_value is not None:
+        set_['hash_value'] = excluded.hash_value
+    elif metadata_changed:
+        set_['hash_value'] = case((or_(*metadata_changed), ''), else_=table.c.hash_value)
+    if tier1_hash:
+        set_['tier1_hash'] = excluded.tier1_hash
+    if filename:
+        set_['filename'] = excluded.filename
+
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.absolute_path], set_=set_)
+    if not engine.dialect.insert_returning:
+        with engine.begin() as connection:
+            connection.execute(stmt)
+        return None
+
+    stmt = stmt.returning(table.c.id, table.c.absolute_path, table.c.hash_value)
+    with engine.begin() as connection:
+        row = connection.execute(stmt).first()
+    return tuple(row) if row is not None else None
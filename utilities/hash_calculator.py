@@ -5,16 +5,127 @@ Functions for calculating file hashes and scanning directories.
 This is purely referenced.
 """
 
+import csv
+import functools
 import hashlib
+import mmap
 import os
 import sys
 import time
-from pathlib import Path
+from collections import defaultdict, deque
+from concurrent.futures import Executor, FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import List, Tuple, Optional, Dict
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, Optional, Dict
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 
-def calculate_file_hash(file_path: str, algorithm: str = "sha256", chunk_size: int = 8192) -> str:
+BUF_SIZE = 1 << 20  # Default read size for full-file hashing (1MB)
+MMAP_THRESHOLD = 4 * 1024 * 1024  # Files at least this large are hashed from a memory map
+MIN_CHUNK_SIZE = 64 * 1024  # Smallest read size chosen by adaptive_chunk_size
+MAX_CHUNK_SIZE = 4 * 1024 * 1024  # Default ceiling for adaptive_chunk_size (matches -c default)
+HASH_THREADS = min(8, os.cpu_count() or 1)  # Default worker threads for hash_files_tiered
+TIER1_SIZE = 65536  # Bytes hashed by tier1 of calculate_file_hash_tiered
+TIER0_SAMPLE = 4096  # Bytes sampled from each end of a file by _fingerprint
+
+
+@functools.lru_cache(maxsize=None)
+def _hasher_factory(algorithm: str) -> Callable:
+    """
+    Resolve and cache the hashlib constructor for an algorithm name.
+
+    Args:
+        algorithm: Hash algorithm name (md5, sha1, sha256, blake2b, blake3, etc.)
+
+    Returns:
+        Zero-argument callable returning a new hash object
+    """
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 requires the blake3 package. Install with: pip install blake3")
+        return blake3.blake3
+    constructor = getattr(hashlib, algorithm, None)
+    if constructor is None:
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        constructor = functools.partial(hashlib.new, algorithm)
+    return constructor
+
+
+def adaptive_chunk_size(file_size: int, max_chunk: int = MAX_CHUNK_SIZE) -> int:
+    """
+    Pick a read size that scales with the file: a power of two between 1/16th
+    and 1/8th of its size, clamped to [MIN_CHUNK_SIZE, max_chunk].
+
+    Args:
+        file_size: Size of the file in bytes
+        max_chunk: Upper bound for the read size
+
+    Returns:
+        Read size in bytes
+    """
+    chunk = max(MIN_CHUNK_SIZE, 1 << max(file_size.bit_length() - 4, 0))
+    return max(1, min(max_chunk, chunk))
+
+
+def _update_from_mmap(hash_func, f, offset: int = 0) -> bool:
+    """
+    Feed an open file (from offset to the end) to a hash object through a read-only memory map.
+
+    Avoids copying every chunk from the page cache into a Python bytes object.
+
+    Args:
+        hash_func: hashlib hash object to update
+        f: File object opened in binary mode
+        offset: Number of leading bytes to skip
+
+    Returns:
+        True if the file was hashed, False if it could not be mapped
+    """
+    try:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            if offset:
+                with memoryview(mm) as view:
+                    hash_func.update(view[offset:])
+            else:
+                hash_func.update(mm)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def _update_from_reads(hash_func, f, chunk_size: int, file_size: int) -> None:
+    """
+    Feed the rest of an open file to a hash object with plain reads.
+
+    Files larger than one chunk are read with readinto into a single reusable
+    buffer, so no bytes object is allocated per chunk; smaller (or unknown-size)
+    files take the simple read() loop.
+
+    Args:
+        hash_func: hashlib hash object to update
+        f: File object opened in binary mode
+        chunk_size: Read size in bytes
+        file_size: Size of the file in bytes (-1 if unknown)
+    """
+    if file_size <= chunk_size:
+        for chunk in iter(functools.partial(f.read, chunk_size), b""):
+            hash_func.update(chunk)
+        return
+    buf = bytearray(chunk_size)
+    with memoryview(buf) as view:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hash_func.update(view[:n])
+
+
+def calculate_file_hash(file_path: str, algorithm: str = "sha256", chunk_size: int = BUF_SIZE) -> str:
     """
     Calculate hash for a single file using specified algorithm.
     
@@ -26,15 +137,17 @@ def calculate_file_hash(file_path: str, algorithm: str = "sha256", chunk_size: i
     Returns:
         File hash as a hexadecimal string
     """
+    hash_func = _hasher_factory(algorithm)()
+
     try:
-        hash_func = getattr(hashlib, algorithm)()
-    except AttributeError:
-        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        file_size = os.path.getsize(file_path)
+    except OSError:
+        file_size = -1
 
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                hash_func.update(chunk)
+            if not (file_size >= MMAP_THRESHOLD and _update_from_mmap(hash_func, f)):
+                _update_from_reads(hash_func, f, chunk_size, file_size)
         return hash_func.hexdigest()
     except (IOError, PermissionError) as e:
         print(f"Warning: Could not read file {file_path}: {e}", file=sys.stderr)
@@ -75,44 +188,80 @@ def get_file_modified_time(file_path: str) -> float:
         return 0.0
 
 
-def calculate_directory_hashes(directory: str, algorithm: str = "sha256") -> List[Tuple]:
+def walk_files(directory: str) -> Iterator[Tuple[str, str, int, float]]:
     """
-    Recursively crawl directory and calculate hashes and sizes for all files.
-    
+    Recursively yield metadata for every regular file below a directory.
+
+    Uses os.scandir so size and modification time come from a single
+    stat() per file instead of separate getsize/getmtime calls.
+
+    Args:
+        directory: Path to the directory to walk
+
+    Yields:
+        Tuples of (filename, absolute_path, file_size, modified_time)
+    """
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from walk_files(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        yield entry.name, os.path.abspath(entry.path), st.st_size, st.st_mtime
+                except OSError as e:
+                    print(f"Warning: Could not access {entry.path}: {e}", file=sys.stderr)
+    except OSError as e:
+        print(f"Warning: Could not scan directory {directory}: {e}", file=sys.stderr)
+
+
+def iter_directory_hashes(directory: str, algorithm: str = "sha256") -> Iterator[Tuple[str, str, str, int, str]]:
+    """
+    Recursively crawl directory and yield hashes and sizes file by file.
+
     Args:
         directory: Path to the directory to scan
         algorithm: Hash algorithm to use
-        
-    Returns:
-        List of tuples containing (filename, absolute_path, hash_value, file_size, scan_date)
+
+    Yields:
+        Tuples of (filename, absolute_path, hash_value, file_size, scan_date)
     """
-    result = []
     scan_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     try:
-        for path in Path(directory).rglob("*"):
-            if path.is_file():
-                file_path = str(path)
-                hash_value = calculate_file_hash(file_path, algorithm)
-                file_size = get_file_size(file_path)
-                filename = os.path.basename(file_path)
-
-                result.append((filename, file_path, hash_value, file_size, scan_date))
+        files = list(walk_files(directory))
+        # hashlib and file reads release the GIL, so threads overlap disk I/O with hashing
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+            hashes = bounded_map(executor, lambda item: calculate_file_hash(item[1], algorithm), files,
+                                 2 * HASH_THREADS)
+            for count, ((filename, file_path, file_size, _), hash_value) in enumerate(zip(files, hashes), 1):
+                yield filename, file_path, hash_value, file_size, scan_date
                 # Print progress every 100 files
-                if len(result) % 100 == 0:
-                    print(f"Processed {len(result)} files...", file=sys.stderr)
+                if count % 100 == 0:
+                    print(f"Processed {count} files...", file=sys.stderr)
 
     except Exception as e:
         print(f"Error accessing directory {directory}: {e}", file=sys.stderr)
 
-    return result
 
-from collections import defaultdict
-from typing import Dict
+def calculate_directory_hashes(directory: str, algorithm: str = "sha256") -> List[Tuple]:
+    """
+    Recursively crawl directory and calculate hashes and sizes for all files.
+    
+    Args:
+        directory: Path to the directory to scan
+        algorithm: Hash algorithm to use
+        
+    Returns:
+        List of tuples containing (filename, absolute_path, hash_value, file_size, scan_date)
+    """
+    return list(iter_directory_hashes(directory, algorithm))
 
 
 def calculate_file_hash_tiered(file_path: str, algorithm: str = "md5",
-                               tier1_size: int = 65536, compute_full: bool = True) -> Tuple[str, Optional[str]]:
+                               tier1_size: int = TIER1_SIZE, compute_full: bool = True,
+                               chunk_size: int = MAX_CHUNK_SIZE) -> Tuple[str, Optional[str]]:
     """
     Two-tier hashing for efficient duplicate detection.
 
@@ -121,6 +270,7 @@ def calculate_file_hash_tiered(file_path: str, algorithm: str = "md5",
         algorithm: Hash algorithm (md5, sha256, etc.)
         tier1_size: Size of first tier in bytes (default 64KB)
         compute_full: If True, compute full file hash after tier1; if False, only tier1 and return None for full
+        chunk_size: Upper bound for the read size of the full pass (see adaptive_chunk_size)
 
     Returns:
         Tuple of (tier1_hash, full_hash) where full_hash is None if compute_full=False
@@ -130,28 +280,30 @@ def calculate_file_hash_tiered(file_path: str, algorithm: str = "md5",
         # tier1 = "a1b2c3d4..." (first 64KB hash)
         # full = "x9y8z7w6..." (entire file hash)
     """
+    hasher = _hasher_factory(algorithm)
     try:
-        hash_func_tier1 = getattr(hashlib, algorithm)()
-        hash_func_full = None
-        if compute_full:
-            hash_func_full = getattr(hashlib, algorithm)()
+        hash_func_tier1 = hasher()
         
         with open(file_path, "rb") as f:
             first_chunk = f.read(tier1_size)
             if first_chunk:
                 hash_func_tier1.update(first_chunk)
-                if compute_full:
-                    hash_func_full.update(first_chunk)
+            
+            # The full hash continues from a snapshot of the tier1 state instead of re-hashing the first chunk
+            hash_func_full = hash_func_tier1.copy() if compute_full else None
             
             if not compute_full:
                 return hash_func_tier1.hexdigest(), None
             
-            # Continue reading the rest for full hash
-            while True:
-                chunk = f.read(8192)
-                if not chunk:
-                    break
-                hash_func_full.update(chunk)
+            # A short first read means the whole file has already been consumed
+            if len(first_chunk) < tier1_size:
+                return hash_func_tier1.hexdigest(), hash_func_full.hexdigest()
+            
+            # Continue with the rest for full hash: mapped when large, else adaptive reads
+            file_size = os.fstat(f.fileno()).st_size
+            if not (file_size >= MMAP_THRESHOLD and _update_from_mmap(hash_func_full, f, tier1_size)):
+                _update_from_reads(hash_func_full, f, adaptive_chunk_size(file_size, chunk_size),
+                                   file_size - tier1_size)
         
         tier1_hash = hash_func_tier1.hexdigest()
         full_hash = hash_func_full.hexdigest() if compute_full else None
@@ -160,8 +312,106 @@ def calculate_file_hash_tiered(file_path: str, algorithm: str = "md5",
     except (IOError, PermissionError) as e:
         error_str = f"ERROR: {str(e)}"
         return error_str, None if not compute_full else error_str
-    except AttributeError:
-        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+
+
+def bounded_map(executor: Executor, fn: Callable, items: Iterable, max_pending: int,
+                ordered: bool = True) -> Iterator[Any]:
+    """
+    Map fn over items on an executor with at most max_pending tasks in flight.
+
+    Unlike Executor.map, items are submitted as earlier results are consumed,
+    so a huge (or lazily generated) input never becomes one future per item.
+
+    Args:
+        executor: Thread or process pool to run on
+        fn: Callable applied to each item
+        items: Iterable of single arguments for fn
+        max_pending: Maximum number of submitted, unconsumed tasks
+        ordered: Yield results in input order (True) or as they complete (False)
+
+    Returns:
+        Iterator of fn(item) results
+    """
+    max_pending = max(1, max_pending)
+    pending = deque() if ordered else set()
+    for item in items:
+        if len(pending) >= max_pending:
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+        future = executor.submit(fn, item)
+        if ordered:
+            pending.append(future)
+        else:
+            pending.add(future)
+
+    if ordered:
+        while pending:
+            yield pending.popleft().result()
+    else:
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def hash_files_tiered(file_paths: Iterable[str], algorithm: str = "md5", compute_full: bool = True,
+                      max_workers: int = HASH_THREADS, executor: Optional[Executor] = None,
+                      **kwargs) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Hash many files with calculate_file_hash_tiered on a thread pool.
+
+    hashlib releases the GIL on large buffers and file reads block outside it,
+    so a few threads keep the disk busy while others hash.
+
+    Args:
+        file_paths: Paths to hash
+        algorithm: Hash algorithm (md5, sha256, etc.)
+        compute_full: Passed to calculate_file_hash_tiered
+        max_workers: Number of hashing threads (1 hashes inline)
+        executor: Pool to run on instead of starting one (max_workers then bounds in-flight tasks)
+        **kwargs: Further calculate_file_hash_tiered options (tier1_size, chunk_size)
+
+    Returns:
+        Iterator of (tier1_hash, full_hash), in the order of file_paths
+    """
+    def hash_one(file_path: str) -> Tuple[str, Optional[str]]:
+        return calculate_file_hash_tiered(file_path, algorithm, compute_full=compute_full, **kwargs)
+
+    if executor is not None:
+        yield from bounded_map(executor, hash_one, file_paths, 2 * max_workers)
+        return
+    if max_workers <= 1:
+        yield from map(hash_one, file_paths)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from bounded_map(executor, hash_one, file_paths, 2 * max_workers)
+
+
+def _fingerprint(file_path: str, file_size: int, sample_size: int = TIER0_SAMPLE) -> Optional[bytes]:
+    """
+    Cheap tier0 fingerprint: a digest of the first and last sample_size bytes.
+
+    Args:
+        file_path: Path to the file
+        file_size: Size of the file in bytes
+        sample_size: Bytes read from each end
+
+    Returns:
+        16-byte digest, or None if the file could not be read
+    """
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(sample_size)
+            tail = b""
+            if file_size > 2 * sample_size:
+                f.seek(-sample_size, os.SEEK_END)
+                tail = f.read(sample_size)
+        return hashlib.blake2b(head + tail, digest_size=16).digest()
+    except OSError:
+        return None
 
 
 def group_files_by_size(directory: str) -> Dict[int, List[str]]:
@@ -183,11 +433,9 @@ def group_files_by_size(directory: str) -> Dict[int, List[str]]:
     size_to_files: Dict[int, List[str]] = defaultdict(list)
     
     try:
-        for path in Path(directory).rglob("*"):
-            if path.is_file():
-                file_size = get_file_size(str(path))
-                if file_size > 0:
-                    size_to_files[file_size].append(str(path))
+        for _, file_path, file_size, _ in walk_files(directory):
+            if file_size > 0:
+                size_to_files[file_size].append(file_path)
     except Exception as e:
         print(f"Error scanning directory {directory}: {e}", file=sys.stderr)
     
@@ -204,20 +452,20 @@ def calculate_directory_hashes_optimized(directory: str, algorithm: str = "md5")
         algorithm: Hash algorithm (md5, sha256, etc.)
 
     Returns:
-        List of tuples: (filename, file_path, tier1_hash, full_hash, file_size, scan_date)
-        Note: full_hash is None for unique-sized files or unique tier1 groups
+        List of tuples: (filename, file_path, tier1_hash, full_hash, file_size, scan_date, modified_time)
+        Note: unique-sized files are never opened, so their tier1_hash is '' and full_hash is None.
+        The same holds for files over TIER1_SIZE whose head+tail sample is unique.
+        full_hash is also None for unique tier1 groups.
     """
     result = []
     scan_date = time.time()
     
     try:
-        # First, group all files by size
+        # First, group all files by size (one stat per file via scandir)
         all_size_groups = defaultdict(list)
-        for path in Path(directory).rglob("*"):
-            if path.is_file():
-                file_size = get_file_size(str(path))
-                if file_size > 0:
-                    all_size_groups[file_size].append(str(path))
+        for filename, file_path, file_size, mtime in walk_files(directory):
+            if file_size > 0:
+                all_size_groups[file_size].append((filename, file_path, mtime))
         
         # For unique size files (len==1), compute tier1 only
         unique_size_files = []
@@ -225,37 +473,58 @@ def calculate_directory_hashes_optimized(directory: str, algorithm: str = "md5")
         
         for size, files in all_size_groups.items():
             if len(files) == 1:
-                unique_size_files.extend(files)
+                unique_size_files.append((size, files[0]))
             else:
                 potential_duplicate_groups[size] = files
         
-        # Process unique size files: tier1 only, full=None
-        for file_path in unique_size_files:
-            filename = os.path.basename(file_path)
-            mtime = get_file_modified_time(file_path)
-            tier1_hash, _ = calculate_file_hash_tiered(file_path, algorithm, compute_full=False)
-            result.append((filename, file_path, tier1_hash, None, get_file_size(file_path), scan_date, mtime))
+        # Unique size files cannot have duplicates: skip opening them entirely
+        # (tier1 stays empty, matching the column default, and full=None)
+        for size, (filename, file_path, mtime) in unique_size_files:
+            result.append((filename, file_path, '', None, size, scan_date, mtime))
         
-        # For potential duplicates: compute tier1, group by tier1, full only for matches
-        for size, files in potential_duplicate_groups.items():
+        # For potential duplicates: compute tier1, group by tier1, full only for matches.
+        # Each tier runs as one pass over all size groups on a single pool, so
+        # parallelism is not capped by the (usually tiny) size of each group
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+            to_tier1 = [(size, item) for size, files in potential_duplicate_groups.items()
+                        if size <= TIER1_SIZE for item in files]
+            sampled = [(size, item) for size, files in potential_duplicate_groups.items()
+                       if size > TIER1_SIZE for item in files]
+
+            # Tier0: files whose head+tail sample is unique for their size cannot be
+            # duplicates, so they skip the 64KB tier1 read (unreadable files go on to tier1)
+            fingerprint_to_files = defaultdict(list)
+            fingerprints = bounded_map(executor, lambda entry: _fingerprint(entry[1][1], entry[0]), sampled,
+                                       2 * HASH_THREADS)
+            for (size, item), fingerprint in zip(sampled, fingerprints):
+                fingerprint_to_files[(size, fingerprint)].append((size, item))
+            for (size, fingerprint), group in fingerprint_to_files.items():
+                if len(group) == 1 and fingerprint is not None:
+                    filename, file_path, mtime = group[0][1]
+                    result.append((filename, file_path, '', None, size, scan_date, mtime))
+                else:
+                    to_tier1.extend(group)
+
             tier1_to_files = defaultdict(list)
-            for file_path in files:
-                filename = os.path.basename(file_path)
-                mtime = get_file_modified_time(file_path)
-                tier1_hash, _ = calculate_file_hash_tiered(file_path, algorithm, compute_full=False)
-                tier1_to_files[tier1_hash].append((filename, file_path, mtime))
-            
+            tier1_hashes = hash_files_tiered([item[1] for _, item in to_tier1], algorithm, compute_full=False,
+                                             executor=executor)
+            for (size, item), (tier1_hash, _) in zip(to_tier1, tier1_hashes):
+                tier1_to_files[(size, tier1_hash)].append(item)
+
             # For each tier1 group
-            for tier1_hash, tier1_files in tier1_to_files.items():
+            to_full = []
+            for (size, tier1_hash), tier1_files in tier1_to_files.items():
                 if len(tier1_files) == 1:
                     # Unique tier1, full=None
                     filename, file_path, mtime = tier1_files[0]
                     result.append((filename, file_path, tier1_hash, None, size, scan_date, mtime))
                 else:
                     # Matches, compute full for all in group
-                    for filename, file_path, mtime in tier1_files:
-                        _, full_hash = calculate_file_hash_tiered(file_path, algorithm, compute_full=True)
-                        result.append((filename, file_path, tier1_hash, full_hash, size, scan_date, mtime))
+                    to_full.extend((size, tier1_hash, item) for item in tier1_files)
+
+            full_hashes = hash_files_tiered([item[1] for _, _, item in to_full], algorithm, executor=executor)
+            for (size, tier1_hash, (filename, file_path, mtime)), (_, full_hash) in zip(to_full, full_hashes):
+                result.append((filename, file_path, tier1_hash, full_hash, size, scan_date, mtime))
         
         # Print progress every 100 files
         if len(result) % 100 == 0:
@@ -265,12 +534,13 @@ def calculate_directory_hashes_optimized(directory: str, algorithm: str = "md5")
         print(f"Error accessing directory {directory}: {e}", file=sys.stderr)
     
     return result
+
+
 if __name__ == "__main__":
     try:
-        hashes = calculate_directory_hashes(sys.argv[1])
-        with open (r'../outputs/directory_hashes.txt', 'w') as wfile:
-            for hash in hashes:
-                wfile.write("filename, file_path, hash_value, file_size" + "\n")
-                wfile.writelines(f'"{hash[0]}, "{hash[1]}", "{hash[2]}", "{hash[3]}"')
+        with open(r'../outputs/directory_hashes.txt', 'w', newline='') as wfile:
+            writer = csv.writer(wfile)
+            writer.writerow(["filename", "file_path", "hash_value", "file_size", "scan_date"])
+            writer.writerows(iter_directory_hashes(sys.argv[1]))
     except Exception as e:
-        print(f'Exception encountered: {str(e)}')
\ No newline at end of file
+        print(f'Exception encountered: {str(e)}')
@@ -1,15 +1,28 @@
 import argparse
+import gzip
 import time
 import json
-from collections import defaultdict
+from contextlib import closing
 from datetime import datetime
+from typing import Dict, Tuple
 from jinja2 import Template
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Custom module Imports
 from utilities.utils import format_file_size, get_size_category
-from utilities.database import get_all_records
+from utilities.database import iter_all_records, iter_duplicate_records, get_duplicates
 import os
 
+# Characters that could end the inline <script> early (e.g. a path containing "</script>"),
+# rewritten as JSON unicode escapes in a single C-level pass over the payload
+_SCRIPT_ESCAPES = str.maketrans({'<': '\\u003c', '>': '\\u003e', '&': '\\u0026'})
+
+# Reports with more rows than this get slow to open in the browser
+LARGE_REPORT_ROWS = 200000
+
 # HTML Template
 HTML_TEMPLATE = '''<!DOCTYPE html>
 <html lang="en">
@@ -59,8 +72,12 @@ HTML_TEMPLATE = '''<!DOCTYPE html>
     </table>
     <div id="toast"></div>
     <script>
-        const allTableData = {{ table_data_json }};
+        // Columnar table data: one array per column, rows addressed by index
+        const tableData = {{ table_data_json }};
+        const duplicateHashes = new Set(tableData.duplicateHashes);
+        const allRows = Array.from(tableData.filenames.keys());
         let dataTable;
+        let lowerPaths;  // Lowercased once, on first use of the exclude filter
 
         function copyToClipboard(text) {
             navigator.clipboard.writeText(text).then(function() {
@@ -73,36 +90,52 @@ HTML_TEMPLATE = '''<!DOCTYPE html>
             });
         }
 
-        function renderTable(data) {
-            if (dataTable) {
-                dataTable.destroy();
-            }
-
-            const tbody = document.querySelector('#hashTable tbody');
-            tbody.innerHTML = '';
-            
-            const fragment = document.createDocumentFragment();
-            for (let i = 0; i < data.length; i++) {
-                const item = data[i];
-                const row = document.createElement('tr');
-                if (item.isDuplicate) row.className = "group-duplicate";
-                row.dataset.hash = item.hash;
-                row.dataset.duplicate = item.isDuplicate;
-                row.innerHTML = `<td>${escapeHtml(item.filename)}</td><td><a href="#" class="copy-path" data-path="${escapeHtml(item.path)}">${escapeHtml(item.path)}</a></td><td>${escapeHtml(item.hash)}</td><td>${escapeHtml(item.size)}</td><td>${escapeHtml(item.sizeCategory)}</td>`;
-                fragment.appendChild(row);
-            }
-            
-            tbody.appendChild(fragment);
+        // Column whose cell text is looked up by row index; escaped only for display
+        function textColumn(value) {
+            return {
+                data: null,
+                render: (i, type) => type === 'display' ? escapeHtml(value(i)) : value(i)
+            };
+        }
 
+        function initTable() {
+            // Rows are plain indexes into tableData; with deferRender DataTables only
+            // builds DOM nodes for the rows it actually draws
             dataTable = $('#hashTable').DataTable({
+                "data": allRows,
+                "columns": [
+                    textColumn(i => tableData.filenames[i]),
+                    {
+                        data: null,
+                        render: (i, type) => {
+                            const path = tableData.paths[i];
+                            if (type !== 'display') return path;
+                            const escaped = escapeHtml(path);
+                            return `<a href="#" class="copy-path" data-path="${escaped}">${escaped}</a>`;
+                        }
+                    },
+                    textColumn(i => tableData.hashes[i]),
+                    textColumn(i => tableData.sizes[i]),
+                    textColumn(i => tableData.categoryNames[tableData.categories[i]])
+                ],
+                "createdRow": function(row, i) {
+                    const hash = tableData.hashes[i];
+                    const isDuplicate = duplicateHashes.has(hash);
+                    if (isDuplicate) row.classList.add("group-duplicate");
+                    row.dataset.hash = hash;
+                    row.dataset.duplicate = isDuplicate;
+                },
                 "pageLength": 25,
                 "lengthMenu": [10, 25, 50, 100],
                 "deferRender": true,
-                "ordering": true,
-                "retrieve": true
+                "ordering": true
             });
         }
 
+        function renderTable(data) {
+            dataTable.clear().rows.add(data).draw();
+        }
+
         function escapeHtml(text) {
             const map = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#039;'};
             return text.replace(/[&<>"']/g, m => map[m]);
@@ -112,28 +145,30 @@ HTML_TEMPLATE = '''<!DOCTYPE html>
             const showOnlyDuplicates = document.getElementById('toggleDuplicates').checked;
             const excludeText = document.getElementById('excludeFilter').value.toLowerCase();
 
-            let filteredData = allTableData;
+            let filteredData = allRows;
 
             if (showOnlyDuplicates) {
-                filteredData = filteredData.filter(item => item.isDuplicate);
+                filteredData = filteredData.filter(i => duplicateHashes.has(tableData.hashes[i]));
             }
 
             if (excludeText) {
-                filteredData = filteredData.filter(item => !item.path.toLowerCase().includes(excludeText));
+                lowerPaths = lowerPaths || tableData.paths.map(p => p.toLowerCase());
+                filteredData = filteredData.filter(i => !lowerPaths[i].includes(excludeText));
             }
 
             renderTable(filteredData);
         }
 
         document.addEventListener('DOMContentLoaded', function() {
-            renderTable(allTableData);
+            initTable();
             document.getElementById('applyExclude').addEventListener('click', applyFilters);
             document.getElementById('applyDuplicates').addEventListener('click', applyFilters);
-            document.addEventListener('click', function(e) {
-                if (e.target.classList.contains('copy-path')) {
-                    e.preventDefault();
-                    copyToClipboard(e.target.dataset.path);
-                }
+            // One listener on the table body handles every (lazily rendered) copy link
+            document.querySelector('#hashTable tbody').addEventListener('click', function(e) {
+                const link = e.target.closest('.copy-path');
+                if (!link) return;
+                e.preventDefault();
+                copyToClipboard(link.dataset.path);
             });
         });
     </script>
@@ -141,73 +176,102 @@ HTML_TEMPLATE = '''<!DOCTYPE html>
 </html>
 '''
 
-def generate_html_report(output_path: str) -> None:
+def generate_html_report(output_path: str, duplicates_only: bool = False) -> None:
     """
     Generate a paginated HTML report with optimized search/filter from the database.
 
     Args:
         output_path: Path to save the HTML report
+        duplicates_only: Only include files whose hash is shared by another file
     """
     start_time = time.time()
-    records = get_all_records()
-    print(f"Retrieved {len(records)} records from database in {time.time() - start_time:.2f} seconds")
-    
+
+    # Duplicate hashes are grouped in SQL (unhashed files are never duplicates)
+    if duplicates_only:
+        records = iter_duplicate_records()
+    else:
+        duplicate_hashes = {hash_value for hash_value, _ in get_duplicates()}
+        records = iter_all_records(order_by_hash=True)
+
+    # Build columnar table data (one array per column) so keys are not repeated per row;
+    # size categories are sent as indexes into categoryNames. Rows stream in hash order,
+    # keeping each duplicate group together.
+    filenames, paths, hashes, sizes, categories = [], [], [], [], []
+    category_index: Dict[str, int] = {}
+    # Many files share a size (empty files, duplicates), so format each size once
+    size_columns: Dict[int, Tuple[str, int]] = {}
+    scan_epoch = None
+    # Bind the per-row methods once; the loop runs for every file in the database
+    add_filename, add_path, add_hash = filenames.append, paths.append, hashes.append
+    add_size, add_category, lookup_size = sizes.append, categories.append, size_columns.get
+    # Close the streaming cursor promptly even if building a row raises
+    with closing(records):
+        for filename, path, hash_value, size_bytes, scan_date in records:
+            if scan_epoch is None:
+                scan_epoch = scan_date  # scan_date is now float epoch
+            add_filename(filename)
+            add_path(path)
+            add_hash(hash_value or '')
+            size_column = lookup_size(size_bytes)
+            if size_column is None:
+                category = category_index.setdefault(get_size_category(size_bytes), len(category_index))
+                size_column = size_columns[size_bytes] = (format_file_size(size_bytes), category)
+            add_size(size_column[0])
+            add_category(size_column[1])
+    total_files = len(filenames)
+    if duplicates_only:
+        duplicate_hashes = set(hashes)
+    print(f"Retrieved {total_files} records from database in {time.time() - start_time:.2f} seconds")
+    if total_files > LARGE_REPORT_ROWS and not duplicates_only:
+        print(f"Report has {total_files} rows; use --duplicates-only to keep it small enough for the browser")
+
     # Convert scan_date epoch to local human-readable for display
     scan_date_display = 'N/A'
-    if records:
-        scan_epoch = records[0][4]  # scan_date is now float epoch
-        if scan_epoch:
-            scan_date_display = datetime.fromtimestamp(scan_epoch).strftime('%Y-%m-%d %H:%M:%S')
-
-    # Group duplicates by hash
-    hash_groups = defaultdict(list)
-    for record in records:
-        hash_groups[record[2]].append(record)
-
-    duplicate_groups = {k for k, v in hash_groups.items() if len(v) > 1}
-
-    # Build table data as JSON for efficient JavaScript processing
-    table_data = []
-    for hash_val, group in hash_groups.items():
-        is_duplicate = hash_val in duplicate_groups
-        for row in group:
-            filename, path, hash_value, size_bytes, scan_date = row
-            size_formatted = format_file_size(size_bytes)
-            size_category = get_size_category(size_bytes)
-            table_data.append({
-                'filename': filename,
-                'path': path,
-                'hash': hash_value,
-                'size': size_formatted,
-                'sizeCategory': size_category,
-                'isDuplicate': is_duplicate
-            })
-
-    # Serialize table data to JSON with minimal overhead
-    table_data_json = json.dumps(table_data, separators=(',', ':'), ensure_ascii=False)
-
-    # Render template
-    template = Template(HTML_TEMPLATE)
-    html = template.render(
-        total_files=len(records),
-        scan_date=scan_date_display,
-        table_data_json=table_data_json
-    )
+    if scan_epoch:
+        scan_date_display = datetime.fromtimestamp(scan_epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+    table_data = {
+        'filenames': filenames,
+        'paths': paths,
+        'hashes': hashes,
+        'sizes': sizes,
+        'categories': categories,
+        'categoryNames': list(category_index),
+        'duplicateHashes': sorted(duplicate_hashes)
+    }
+
+    # Serialize table data to JSON with minimal overhead (orjson when installed)
+    if orjson is not None:
+        table_data_json = orjson.dumps(table_data).decode('utf-8')
+    else:
+        table_data_json = json.dumps(table_data, separators=(',', ':'), ensure_ascii=False)
+    table_data_json = table_data_json.translate(_SCRIPT_ESCAPES)
 
     # Ensure output directory exists
     dir_path = os.path.dirname(output_path)
     if dir_path:
         os.makedirs(dir_path, exist_ok=True)
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(html)
+    # Stream the rendered template into the file instead of building the whole page in memory;
+    # a .gz output path is compressed on the fly
+    if output_path.endswith('.gz'):
+        report_file = gzip.open(output_path, 'wt', encoding='utf-8', compresslevel=6)
+    else:
+        report_file = open(output_path, 'w', encoding='utf-8')
+    with report_file as f:
+        Template(HTML_TEMPLATE).stream(
+            total_files=total_files,
+            scan_date=scan_date_display,
+            table_data_json=table_data_json
+        ).dump(f)
 
     print(f"HTML report generated in {time.time() - start_time:.2f} seconds")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a file hash HTML report.")
     parser.add_argument("--report", required=True, help="Output HTML file path")
+    parser.add_argument("--duplicates-only", action="store_true", help="Only include duplicate files")
 
     args = parser.parse_args()
 
-    generate_html_report(args.report)
+    generate_html_report(args.report, duplicates_only=args.duplicates_only)